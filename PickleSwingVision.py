@@ -14,6 +14,8 @@ class PickleSwingVision:
         print('ball detection')
 
         self.ball_detector = BallDetector(args[ "path_ball_track_model" ], device)
+        self.ball_stream = self.ball_detector.stream()
+        self._last_ball_frame = None
         self.bounce_detector = BounceDetector(args[ "path_bounce_model" ])
         # self.ball_tracker = BallTracker(model_path='models2/yolo5_last.pt')
         self.ball_tracker = BallTracker(model_path='models/best.pt')
@@ -23,12 +25,23 @@ class PickleSwingVision:
     def get_ball_trajectory(self):
         return self._ball_trajectory
 
-    #brief: function to track the ball
-    #params: frames: list of 3 consecutive video frames 
-    def track_ball(self, frames, frame_index):
-        ball_track = self.ball_detector.infer_model(frames)
-        self._ball_trajectory[frame_index] = ball_track
-        return ball_track
+    #brief: function to track the ball with TrackNet one frame at a time
+    #params: frame: next video frame
+    #        frame_index: index of the frame in the video, the detector
+    #        starts over when it does not follow the previous one
+    #returns: (x,y) ball coordinates or (None, None)
+    def track_ball(self, frame, frame_index):
+        if self._last_ball_frame is None or frame_index != self._last_ball_frame + 1:
+            self.ball_stream.reset()
+        self._last_ball_frame = frame_index
+        ball_point = self.ball_stream.push(frame)
+        self._ball_trajectory[frame_index] = ball_point
+        return ball_point
+
+    #brief: function to forget previous frames after a seek
+    def reset_ball_tracking(self):
+        self.ball_stream.reset()
+        self._last_ball_frame = None
 
     def track_ball2(self, frame):
         ball_track = self.ball_tracker.detect_frame(frame)
@@ -50,6 +63,14 @@ class PickleSwingVision:
         bounces = list(self.bounce_detector.predict(x_ball, y_ball))
         return bounces
 
+    #brief: function to update bounces of a growing ball track
+    #params: bounces: list of bounces from the previous update
+    # x_ball, y_ball: ball coordinates already smoothed with smooth_ball_track
+    # window: number of last images to look for bounces in
+    #returns: bounces: sorted list of image numbers with a bounce
+    def update_bounces(self, bounces, x_ball, y_ball, window):
+        return self.bounce_detector.update_bounces(bounces, x_ball, y_ball, window, smooth=False)
+
 
     def smooth_ball_track(self, ball_track):
         x_ball = [x[0] for x in ball_track]
@@ -222,6 +222,14 @@ Window {
                     }
                 }
             }
+
+            CheckBox {
+                text: "TrackNet"
+                checked: false
+                onToggled: {
+                    video_controller.set_use_tracknet(checked);
+                }
+            }
         }
     }
 
@@ -68,6 +68,11 @@ class VideoController(QObject):
         self.playingStatusChanged.emit(False)
         self.videoProcessor.pausePlayLoop()
 
+    @Slot(bool)
+    def set_use_tracknet(self, use_tracknet: bool):
+        # called directly like pause_analyze, a queued request would wait for the play loop to end
+        self.videoProcessor.set_use_tracknet(use_tracknet)
+
     @Slot()
     def get_next_frame(self):
         self.requestGetNext.emit()
@@ -43,6 +43,11 @@ class VideoProcessor(QObject):
         )
 
         self.ball_trajectory = []
+        self.bounces = []
+        # a new ball position only changes the bounces of the last frames, see BounceDetector.update_bounces
+        self.bounce_window = 100
+        # TrackNet keeps its own 3-frame window, the YOLO tracker looks at single frames
+        self.use_tracknet = False
         self.keep_playing = False
         self.track_ball = False
         self.thread = QThread()
@@ -110,20 +115,17 @@ class VideoProcessor(QObject):
 
     @Slot()
     def trackBallTrajectory(self):
-        # comment out tracknet
-        # if self.current_frame < 2:
-        #     return
-        # process_frames = self.frames[self.current_frame - 2 : self.current_frame + 1]
-        # ball_track = self.pickle_vision.track_ball(process_frames, self.current_frame)
-
         ball_track = []
-        ball2 = self.pickle_vision.track_ball2(self.frames[self.current_frame])
-        if ball2:
-            result = ball2[1]
-            ball_track.append(((result[0] + result[2]) / 2, (result[1] + result[3]) / 2))
+        if self.use_tracknet:
+            ball_track.append(self.pickle_vision.track_ball(self.frames[self.current_frame], self.current_frame))
         else:
-            # print ("Frame without ball: ", self.current_frame)
-            ball_track.append((None, None))
+            ball2 = self.pickle_vision.track_ball2(self.frames[self.current_frame])
+            if ball2:
+                result = ball2[1]
+                ball_track.append(((result[0] + result[2]) / 2, (result[1] + result[3]) / 2))
+            else:
+                # print ("Frame without ball: ", self.current_frame)
+                ball_track.append((None, None))
 
         while self.current_frame > len(self.ball_trajectory):
             self.ball_trajectory.append((None, None))
@@ -139,10 +141,11 @@ class VideoProcessor(QObject):
             self.ball_trajectory[-1] = (x_track[-1], y_track[-1])
 
 
+        # the track is already smoothed, bounce detection does not smooth it again
+        self.bounces = self.pickle_vision.update_bounces(self.bounces, x_track, y_track, self.bounce_window)
+
         x_track = [x if x is not None else 0 for x in x_track]
         y_track = [y if y is not None else 0 for y in y_track]
-
-        self.bounces = self.pickle_vision.bounce_detect(self.ball_trajectory)
         self.bouncesDetected.emit([(frame_id, x_track[frame_id], y_track[frame_id]) for frame_id in self.bounces])
 
         # plot ball track
@@ -167,6 +170,7 @@ class VideoProcessor(QObject):
                 break
 
         if frame_id < len(self.frames):
+            self.pickle_vision.reset_ball_tracking()
             self.current_frame = frame_id - 1
             self.track_ball = False
             self.keep_playing = False
@@ -186,6 +190,10 @@ class VideoProcessor(QObject):
         self.keep_playing = False
         self.track_ball = False
 
+    def set_use_tracknet(self, use_tracknet: bool):
+        # PickleSwingVision.track_ball restarts the ball stream when frames were skipped in between
+        self.use_tracknet = use_tracknet
+
     @Slot()
     def processNextFrame(self):
         ret, frame = self.cap.read()
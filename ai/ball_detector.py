@@ -1,83 +1,312 @@
 from numpy._typing import _16Bit
 from numpy.core.fromnumeric import shape
-from .tracknet import BallTrackerNet
+from .tracknet import BallTrackerNet, fuse_tracknet
+from .onnx_backend import export_onnx, load_onnx_model, load_int8_model
 import torch
 import torchvision
 import cv2
 import numpy as np
 from scipy.spatial import distance
+from collections import deque
 from tqdm import tqdm
 
 
 class BallDetector:
-    def __init__(self, path_model=None, device="cuda"):
+    def __init__(self, path_model=None, device="cuda", decoder="blob", backend="torch", num_threads=None,
+                 roi_size=None, roi_interval=30, tile_rows=None):
+        """
+        :params
+            path_model: path to pretrained TrackNet weights
+            device: torch device to run the model on
+            decoder: "blob" to decode the heatmaps of a whole batch with cv2.HoughCircles on crops around
+                the ball pixels, "hough" to run cv2.HoughCircles on every whole heatmap. Both give the same
+                ball positions, with radius between min_radius and max_radius
+            backend: "torch" to run the model with PyTorch, "onnx" to run its ONNX export
+                with ONNX Runtime on CPU. The export is cached next to the weights.
+                "onnx-int8" runs the INT8 model calibrated with others/quantize.py,
+                "fused" runs an inference-only copy of the model with BatchNorm folded into convolutions
+            num_threads: number of threads for the onnx backends, all cores by default.
+                Torch backends follow the process-wide torch.set_num_threads
+            roi_size: (width, height) of the crop around the expected ball position the model runs on
+                while the ball is tracked, in model input pixels and multiples of 8.
+                None runs the model on full frames only
+            roi_interval: maximum number of consecutive frames processed on crops
+                before the next full frame
+            tile_rows: evaluate the 256-channel last block and the argmax over it in tiles of this many rows,
+                so its full resolution output is never allocated. Torch and fused backends only
+        """
+        if tile_rows and backend not in ("torch", "fused"):
+            raise ValueError("tile_rows needs the torch or fused backend, not {}".format(backend))
         self.model = BallTrackerNet(input_channels=9, out_channels=256)
         self.device = device
+        self.decoder = decoder
+        self.min_radius = 2
+        self.max_radius = 7
+        self.width = 640
+        self.height = 360
+        self.roi_size = roi_size
+        self.roi_interval = roi_interval
+        self.tile_rows = tile_rows
+        # output buffers reused across frames, by name and shape
+        self.buffers = {}
         if path_model:
             self.model.load_state_dict(
                 torch.load(path_model, map_location=device, weights_only=True)
             )
             self.model = self.model.to(device)
             self.model.eval()
-        self.width = 640
-        self.height = 360
+            if backend == "fused":
+                self.model = fuse_tracknet(self.model)
+            elif backend == "onnx":
+                self.model = load_onnx_model(self.model, path_model, (9, self.height, self.width), num_threads)
+                self.device = "cpu"
+            elif backend == "onnx-int8":
+                self.model = load_int8_model(path_model, num_threads)
+                self.device = "cpu"
 
-    def convert_to_onnx(self):
-        dummy_input = torch.randn(1, 9, self.height, self.width).float().to(self.device)
-        torch.onnx.export(
-            self.model,
-            dummy_input,
-            "model.onnx",
-            input_names=["input"],
-            output_names=["output"],
-            dynamic_axes={"input": {0: "batch_size"}, "output": {0: "batch_size"}},
-        )
+    def convert_to_onnx(self, path_onnx="model.onnx"):
+        export_onnx(self.model, path_onnx, (9, self.height, self.width), self.device)
 
-    def infer_model(self, frames):
+    def infer_model(self, frames, batch_size=1):
         """Run pretrained model on a consecutive list of frames
         :params
             frames: list of consecutive video frames
+            batch_size: number of frames per forward pass
         :return
             ball_track: list of detected ball points
         """
-        ball_track = [(None, None)] * 2
-        prev_pred = [None, None]
         print("Ball detector processing")
-        scale = []
-        for num in range(2, len(frames)):
-            img = cv2.resize(frames[num], (self.width, self.height))
+        return list(self.infer_frames(frames, batch_size=batch_size))
+
+    def infer_frames(self, frames, scale=None, batch_size=1):
+        """Run pretrained model on a stream of consecutive frames. Only the last 3 frames
+        and the current batch are kept, so frames can be a generator over a video of any length
+        :params
+            frames: iterable of consecutive video frames, original or already resized
+                to the model input size
+            scale: scale for conversion to original shape, required for resized frames
+            batch_size: number of 3-frame windows stacked into one forward pass,
+                frames are processed one by one while the ball is tracked on crops
+        :return
+            generator of detected ball points, one per input frame
+        """
+        if self.roi_size:
+            # crops depend on the previous detection, so frames go through the model one by one
+            stream = self.stream(scale)
+            for frame in frames:
+                yield stream.push(frame)
+            return
+        # last 3 frames already resized and converted to float32 CHW, newest last
+        window = deque(maxlen=3)
+        prev_pred = [None, None]
+        scale = list(scale) if scale else []
+        inp = np.empty((batch_size, 9, self.height, self.width), dtype=np.float32)
+        num = 0
+        for frame in frames:
+            window.append(self.prepare(frame))
             if not scale:
-                scale.append(frames[num].shape[1] / self.width)
-                scale.append(frames[num].shape[0] / self.height)
-            img_prev = cv2.resize(frames[num - 1], (self.width, self.height))
-            img_preprev = cv2.resize(frames[num - 2], (self.width, self.height))
-            imgs = np.concatenate((img, img_prev, img_preprev), axis=2)
-            imgs = imgs.astype(np.float32) / 255.0
-            imgs = np.rollaxis(imgs, 2, 0)
-            inp = np.expand_dims(imgs, axis=0)
-#            print("input shape: ", inp.shape)
-
-            out = self.model(torch.from_numpy(inp).float().to(self.device))
-            output = out.argmax(dim=1).detach().cpu().numpy()
-            x_pred, y_pred = self.postprocess(output, prev_pred, scale)
-            prev_pred = [x_pred, y_pred]
-            ball_track.append((x_pred, y_pred))
-        return ball_track
-
-    def postprocess(self, feature_map, prev_pred, scale=[2, 2], max_dist=80):
+                scale.append(frame.shape[1] / self.width)
+                scale.append(frame.shape[0] / self.height)
+            if len(window) < 3:
+                yield (None, None)
+                continue
+            np.concatenate((window[2], window[1], window[0]), axis=0, out=inp[num])
+            num += 1
+            if num == batch_size:
+                yield from self.postprocess_batch(self.infer_batch(inp), prev_pred, scale)
+                num = 0
+        if num:
+            yield from self.postprocess_batch(self.infer_batch(inp[:num]), prev_pred, scale)
+
+    def stream(self, scale=None):
+        """
+        :params
+            scale: scale for conversion to original shape, required for resized frames
+        :return
+            BallStream that detects the ball one frame at a time
+        """
+        return BallStream(self, scale)
+
+    def predict_center(self, history):
+        """Expected ball position from the last two detections assuming constant velocity
+        :params
+            history: last 2 ball positions in model input pixels, None where the ball was not found
+        :return
+            x,y expected position in model input pixels or None if the ball is not tracked
+        """
+        prev, last = history
+        if last is None:
+            return None
+        if prev is None:
+            return last
+        return 2 * last[0] - prev[0], 2 * last[1] - prev[1]
+
+    def infer_roi(self, window, center):
+        """Run pretrained model on a crop of the 3-frame window around center
+        :params
+            window: last 3 prepared frames, newest last
+            center: x,y expected ball position in model input pixels
+        :return
+            ball mask with shape (1,360,640), zero outside the crop
+        """
+        roi_width, roi_height = self.roi_size
+        # crops start on multiples of 8 so the 3 pooling layers see the same grid as on the full frame
+        x0 = int(np.clip(center[0] - roi_width / 2, 0, self.width - roi_width)) // 8 * 8
+        y0 = int(np.clip(center[1] - roi_height / 2, 0, self.height - roi_height)) // 8 * 8
+        crop = (slice(None), slice(y0, y0 + roi_height), slice(x0, x0 + roi_width))
+        inp = np.concatenate((window[2][crop], window[1][crop], window[0][crop]), axis=0)[None]
+        masks = self.get_buffer("roi", (1, self.height, self.width), np.uint8)
+        masks.fill(0)
+        masks[0, y0:y0 + roi_height, x0:x0 + roi_width] = self.infer_batch(inp)[0]
+        return masks
+
+    def infer_batch(self, inp):
+        """Run pretrained model on a batch of inputs and binarize its output on the device,
+        only the uint8 masks are copied back
+        :params
+            inp: input array with shape (batch,9,height,width), full frames or crops
+        :return
+            ball masks with shape (batch,height,width), 255 where the ball may be and 0 elsewhere.
+            The array is overwritten by the next call with the same shape
+        """
+        with torch.inference_mode():
+            inp = torch.from_numpy(inp).to(self.device)
+            if self.tile_rows:
+                classes = self.model.forward_argmax(inp, self.tile_rows)
+            else:
+                classes = self.model(inp).argmax(dim=1)
+            # the heatmap used to be the class index times 255 cast to uint8 and thresholded at 127,
+            # after the uint8 wrap-around that selects exactly the classes 1..128
+            mask = ((classes > 0) & (classes <= 128)).to(torch.uint8).mul_(255)
+            buffer = self.get_buffer("mask", tuple(mask.shape), torch.uint8)
+            buffer.copy_(mask)
+        return buffer.numpy()
+
+    def get_buffer(self, name, shape, dtype):
+        """
+        :return
+            array or pinned tensor for torch dtypes, allocated on the first request of name and shape
+        """
+        key = (name, shape)
+        if key not in self.buffers:
+            if isinstance(dtype, torch.dtype):
+                pin_memory = str(self.device).startswith("cuda")
+                self.buffers[key] = torch.empty(shape, dtype=dtype, pin_memory=pin_memory)
+            else:
+                self.buffers[key] = np.empty(shape, dtype=dtype)
+        return self.buffers[key]
+
+    def postprocess_batch(self, masks, prev_pred, scale):
+        """Postprocess ball masks of consecutive frames one after another
+        :params
+            masks: ball masks with shape (batch,360,640)
+            prev_pred: [x,y] coordinates of ball prediction from previous frame, updated in place
+            scale: scale for conversion to original shape
+        :return
+            generator of x,y ball coordinates
+        """
+        if self.decoder == "hough":
+            for mask in masks:
+                x_pred, y_pred = self.postprocess(mask, prev_pred, scale)
+                prev_pred[:] = [x_pred, y_pred]
+                yield (x_pred, y_pred)
+            return
+        for blobs in self.find_blobs(masks):
+            x_pred, y_pred = self.select_blob(blobs, prev_pred, scale)
+            prev_pred[:] = [x_pred, y_pred]
+            yield (x_pred, y_pred)
+
+    def find_blobs(self, masks, margin=16):
+        """Find ball candidates in a batch of ball masks. The bounding boxes of the ball pixels of all masks
+        are found at once, empty masks are skipped and cv2.HoughCircles only runs on the bounding box grown
+        by margin. Circle centers get votes at most max_radius pixels away from the edges and the crop keeps
+        the order HoughCircles breaks ties in, so the candidates are the same as on the whole mask
+        :params
+            masks: ball masks with shape (batch,360,640)
+            margin: pixels added around the ball pixels, more than max_radius
+        :return
+            list of arrays with shape (num_blobs,2), x,y centers of circles in every mask
+            in the order of HoughCircles
+        """
+        rows = masks.any(axis=2)
+        cols = masks.any(axis=1)
+        blobs = []
+        for mask, row, col in zip(masks, rows, cols):
+            ys = np.flatnonzero(row)
+            xs = np.flatnonzero(col)
+            circles = None
+            if len(ys) > 0:
+                y_min, y_max = max(ys[0] - margin, 0), min(ys[-1] + margin + 1, self.height)
+                x_min, x_max = max(xs[0] - margin, 0), min(xs[-1] + margin + 1, self.width)
+                circles = cv2.HoughCircles(
+                    np.ascontiguousarray(mask[y_min:y_max, x_min:x_max]),
+                    cv2.HOUGH_GRADIENT,
+                    dp=1,
+                    minDist=1,
+                    param1=50,
+                    param2=2,
+                    minRadius=self.min_radius,
+                    maxRadius=self.max_radius,
+                )
+            if circles is None:
+                blobs.append(np.empty((0, 2), dtype=np.float32))
+            else:
+                blobs.append(circles[0][:, :2] + np.float32([x_min, y_min]))
+        return blobs
+
+    def select_blob(self, blobs, prev_pred, scale, max_dist=80):
         """
         :params
-            feature_map: feature map with shape (1,360,640)
+            blobs: array with shape (num_blobs,2) of candidate ball coordinates in mask pixels
+            prev_pred: [x,y] coordinates of ball prediction from previous frame
+            scale: scale for conversion to original shape
+            max_dist: maximum distance from previous ball detection to remove outliers
+        :return
+            x,y ball coordinates, the first candidate close enough to the previous detection
+            as chosen by postprocess
+        """
+        x, y = None, None
+        if len(blobs) > 0:
+            num = 0
+            if prev_pred[0]:
+                dists = np.hypot(blobs[:, 0].astype(np.float64) * scale[0] - prev_pred[0],
+                                 blobs[:, 1].astype(np.float64) * scale[1] - prev_pred[1])
+                inds = np.flatnonzero(dists < max_dist)
+                num = inds[0] if len(inds) > 0 else None
+            if num is not None:
+                # scaled like in postprocess, so the coordinates have the same type and value
+                x = blobs[num][0] * scale[0]
+                y = blobs[num][1] * scale[1]
+        return x, y
+
+    def resize(self, frame):
+        if frame.shape[:2] == (self.height, self.width):
+            return frame
+        return cv2.resize(frame, (self.width, self.height))
+
+    def prepare(self, frame):
+        """Resize frame to the model input size and convert it to normalized float32 CHW
+        :params
+            frame: original or already resized video frame
+        :return
+            array with shape (3,360,640)
+        """
+        img = self.resize(frame)
+        chw = np.empty((3, self.height, self.width), dtype=np.float32)
+        np.divide(img.transpose(2, 0, 1), np.float32(255.0), out=chw)
+        return chw
+
+    def postprocess(self, mask, prev_pred, scale=[2, 2], max_dist=80):
+        """
+        :params
+            mask: ball mask with shape (360,640), 255 where the ball may be
             prev_pred: [x,y] coordinates of ball prediction from previous frame
             scale: scale for conversion to original shape (720,1280)
             max_dist: maximum distance from previous ball detection to remove outliers
         :return
             x,y ball coordinates
         """
-        feature_map *= 255
-        feature_map = feature_map.reshape((self.height, self.width))
-        feature_map = feature_map.astype(np.uint8)
-        ret, heatmap = cv2.threshold(feature_map, 127, 255, cv2.THRESH_BINARY)
+        heatmap = mask.reshape((self.height, self.width))
         circles = cv2.HoughCircles(
             heatmap,
             cv2.HOUGH_GRADIENT,
@@ -85,8 +314,8 @@ class BallDetector:
             minDist=1,
             param1=50,
             param2=2,
-            minRadius=2,
-            maxRadius=7,
+            minRadius=self.min_radius,
+            maxRadius=self.max_radius,
         )
         x, y = None, None
         if circles is not None:
@@ -102,3 +331,63 @@ class BallDetector:
                 x = circles[0][0][0] * scale[0]
                 y = circles[0][0][1] * scale[1]
         return x, y
+
+
+class BallStream:
+    """
+    Detect the ball in frames pushed one at a time, e.g. while a video is played.
+    The 3-frame window, the previous detection and the crop tracking state are kept between calls,
+    so every frame costs a single forward pass
+    """
+    def __init__(self, ball_detector, scale=None):
+        """
+        :params
+            ball_detector: BallDetector instance
+            scale: scale for conversion to original shape, taken from the first frame if not given
+        """
+        self.ball_detector = ball_detector
+        self.scale = list(scale) if scale else []
+        self.inp = np.empty((1, 9, ball_detector.height, ball_detector.width), dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        """Forget previous frames, call it when the next frame does not follow the last pushed one"""
+        # last 3 frames already resized and converted to float32 CHW, newest last
+        self.window = deque(maxlen=3)
+        self.prev_pred = [None, None]
+        # last 2 ball positions in model input pixels and frames processed on crops since the last full frame
+        self.history = deque([None, None], maxlen=2)
+        self.num_roi = 0
+
+    def push(self, frame):
+        """
+        :params
+            frame: next video frame, original or already resized to the model input size
+        :return
+            x,y ball coordinates in the frame, None until 3 frames have been pushed
+        """
+        detector = self.ball_detector
+        self.window.append(detector.prepare(frame))
+        if not self.scale:
+            self.scale.append(frame.shape[1] / detector.width)
+            self.scale.append(frame.shape[0] / detector.height)
+        if len(self.window) < 3:
+            return None, None
+
+        x_pred, y_pred = None, None
+        if detector.roi_size:
+            center = detector.predict_center(self.history)
+            if center is not None and self.num_roi < detector.roi_interval:
+                pred = list(self.prev_pred)
+                masks = detector.infer_roi(self.window, center)
+                (x_pred, y_pred), = detector.postprocess_batch(masks, pred, self.scale)
+                self.num_roi += 1
+        if x_pred is None:
+            # not tracking, nothing in the crop or time to look at the whole frame again
+            np.concatenate((self.window[2], self.window[1], self.window[0]), axis=0, out=self.inp[0])
+            masks = detector.infer_batch(self.inp)
+            (x_pred, y_pred), = detector.postprocess_batch(masks, self.prev_pred, self.scale)
+            self.num_roi = 0
+        self.prev_pred[:] = [x_pred, y_pred]
+        self.history.append(None if x_pred is None else (x_pred / self.scale[0], y_pred / self.scale[1]))
+        return x_pred, y_pred
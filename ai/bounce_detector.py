@@ -1,5 +1,4 @@
 import catboost as ctb
-import pandas as pd
 import numpy as np
 from scipy.interpolate import CubicSpline
 from scipy.spatial import distance
@@ -8,49 +7,83 @@ class BounceDetector:
     def __init__(self, path_model=None):
         self.model = ctb.CatBoostRegressor()
         self.threshold = 0.45
+        # frames of track smoothed before a prediction window
+        self.smooth_context = 8
         if path_model:
             self.load_model(path_model)
         
     def load_model(self, path_model):
         self.model.load_model(path_model)
     
-    def prepare_features(self, x_ball, y_ball):
-        labels = pd.DataFrame({'frame': range(len(x_ball)), 'x-coordinate': x_ball, 'y-coordinate': y_ball})
-        
+    def prepare_features(self, x_ball, y_ball, window=None):
+        """
+        Build the lag features of every frame with the ball at the frame and 2 frames before and after it.
+        Lags are read from one sliding window over the coordinates padded with nan, which gives the same
+        columns as the previous pandas shift based version
+        :params
+            x_ball: list of x ball coordinates or None
+            y_ball: list of y ball coordinates or None
+            window: number of last frames to build features for, all frames if None
+        :return
+            features: array with 12 feature columns
+            frames: list of frame numbers of the feature rows
+        """
         num = 3
         eps = 1e-15
-        for i in range(1, num):
-            labels['x_lag_{}'.format(i)] = labels['x-coordinate'].shift(i)
-            labels['x_lag_inv_{}'.format(i)] = labels['x-coordinate'].shift(-i)
-            labels['y_lag_{}'.format(i)] = labels['y-coordinate'].shift(i)
-            labels['y_lag_inv_{}'.format(i)] = labels['y-coordinate'].shift(-i) 
-            labels['x_diff_{}'.format(i)] = abs(labels['x_lag_{}'.format(i)] - labels['x-coordinate'])
-            labels['y_diff_{}'.format(i)] = labels['y_lag_{}'.format(i)] - labels['y-coordinate']
-            labels['x_diff_inv_{}'.format(i)] = abs(labels['x_lag_inv_{}'.format(i)] - labels['x-coordinate'])
-            labels['y_diff_inv_{}'.format(i)] = labels['y_lag_inv_{}'.format(i)] - labels['y-coordinate']
-            labels['x_div_{}'.format(i)] = abs(labels['x_diff_{}'.format(i)]/(labels['x_diff_inv_{}'.format(i)] + eps))
-            labels['y_div_{}'.format(i)] = labels['y_diff_{}'.format(i)]/(labels['y_diff_inv_{}'.format(i)] + eps)
+        start = 0 if window is None else max(len(x_ball) - window, 0)
+        # only the window and the lags before it are converted
+        first = max(start - num + 1, 0)
+        x = np.array([np.nan if v is None else v for v in x_ball[first:]], dtype=np.float64)
+        y = np.array([np.nan if v is None else v for v in y_ball[first:]], dtype=np.float64)
 
-        for i in range(1, num):
-            labels = labels[labels['x_lag_{}'.format(i)].notna()]
-            labels = labels[labels['x_lag_inv_{}'.format(i)].notna()]
-        labels = labels[labels['x-coordinate'].notna()] 
-        
-        colnames_x = ['x_diff_{}'.format(i) for i in range(1, num)] + \
-                     ['x_diff_inv_{}'.format(i) for i in range(1, num)] + \
-                     ['x_div_{}'.format(i) for i in range(1, num)]
-        colnames_y = ['y_diff_{}'.format(i) for i in range(1, num)] + \
-                     ['y_diff_inv_{}'.format(i) for i in range(1, num)] + \
-                     ['y_div_{}'.format(i) for i in range(1, num)]
-        colnames = colnames_x + colnames_y
+        # column k of row t holds the coordinate of frame t - num + 1 + k, one more padded value on the right
+        # keeps an empty track at least as long as the window
+        pad = (num - 1 - (start - first), num)
+        x_win = np.lib.stride_tricks.sliding_window_view(np.pad(x, pad, constant_values=np.nan), 2 * num - 1)
+        y_win = np.lib.stride_tricks.sliding_window_view(np.pad(y, pad, constant_values=np.nan), 2 * num - 1)
+        x_win, y_win = x_win[:len(x_ball) - start], y_win[:len(x_ball) - start]
+        x_cur, y_cur = x_win[:, num - 1:num], y_win[:, num - 1:num]
+        x_lag, x_lag_inv = x_win[:, num - 2::-1], x_win[:, num:]
+        y_lag, y_lag_inv = y_win[:, num - 2::-1], y_win[:, num:]
 
-        features = labels[colnames]
-        return features, list(labels['frame'])
-    
-    def predict(self, x_ball, y_ball, smooth=True):
+        x_diff = abs(x_lag - x_cur)
+        x_diff_inv = abs(x_lag_inv - x_cur)
+        y_diff = y_lag - y_cur
+        y_diff_inv = y_lag_inv - y_cur
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_div = abs(x_diff / (x_diff_inv + eps))
+            y_div = y_diff / (y_diff_inv + eps)
+
+        valid = ~np.isnan(x_win).any(axis=1)
+        features = np.concatenate([x_diff, x_diff_inv, x_div, y_diff, y_diff_inv, y_div], axis=1)[valid]
+        frames = np.arange(start, len(x_ball))[valid]
+        return features, frames.tolist()
+
+    def predict(self, x_ball, y_ball, smooth=True, window=None):
+        """
+        :params
+            x_ball: list of x ball coordinates or None
+            y_ball: list of y ball coordinates or None
+            smooth: fill short gaps of the track before predicting
+            window: only predict bounces in this number of last frames, all frames if None.
+                Results can differ from the whole track near the window start: smoothing only starts
+                smooth_context frames before the window, and bounces in consecutive feature rows are
+                only merged inside the window
+        :return
+            set of frame numbers with a bounce
+        """
         if smooth:
-            x_ball, y_ball = self.smooth_predictions(x_ball, y_ball)
-        features, num_frames = self.prepare_features(x_ball, y_ball)
+            if window is None:
+                x_ball, y_ball = self.smooth_predictions(x_ball, y_ball)
+            else:
+                # smoothing looks at the previous frames, so start it a few frames before the window
+                offset = max(len(x_ball) - window - self.smooth_context, 0)
+                x_tail, y_tail = self.smooth_predictions(list(x_ball[offset:]), list(y_ball[offset:]))
+                x_ball = list(x_ball[:offset]) + x_tail
+                y_ball = list(y_ball[:offset]) + y_tail
+        features, num_frames = self.prepare_features(x_ball, y_ball, window)
+        if len(features) == 0:
+            return set()
         preds = self.model.predict(features)
         ind_bounce = np.where(preds > self.threshold)[0]
         if len(ind_bounce) > 0:
@@ -58,6 +91,30 @@ class BounceDetector:
         frames_bounce = [num_frames[x] for x in ind_bounce]
         return set(frames_bounce)
     
+    def update_bounces(self, bounces, x_ball, y_ball, window, smooth=True):
+        """
+        Update the bounces of a track that grows frame by frame by predicting only its last frames.
+        A new ball position only changes the features of the last frames, so bounces in the first half
+        of the window are kept from the previous update, when they were further from the window start.
+        The rest of the window is predicted again, and a new bounce next to a kept one is dropped
+        like postprocess merges consecutive bounces
+        :params
+            bounces: frame numbers with a bounce from the previous update
+            x_ball: list of x ball coordinates or None
+            y_ball: list of y ball coordinates or None
+            window: number of last frames to predict
+            smooth: fill short gaps of the track before predicting
+        :return
+            sorted list of frame numbers with a bounce
+        """
+        start = max(len(x_ball) - window, 0)
+        keep_until = start + window // 2 if start > 0 else 0
+        kept = sorted(frame for frame in bounces if frame < keep_until)
+        new = sorted(frame for frame in self.predict(x_ball, y_ball, smooth, window) if frame >= keep_until)
+        if kept and new and new[0] - kept[-1] <= 1:
+            new = new[1:]
+        return kept + new
+
     def smooth_predictions(self, x_ball, y_ball):
         is_none = [int(x is None) for x in x_ball]
         interp = 4
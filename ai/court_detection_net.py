@@ -1,62 +1,282 @@
 import cv2
 import numpy as np
 import torch
-from .tracknet import BallTrackerNet
+from .tracknet import BallTrackerNet, fuse_tracknet
 import torch.nn.functional as F
 from tqdm import tqdm
-from .postprocess import refine_kps
-from .homography import get_trans_matrix, refer_kps
+from .postprocess import refine_kps_batch
+from .homography import get_trans_matrices, refer_kps, court_ref
+from .onnx_backend import load_onnx_model, load_int8_model
+
+def sample_court_lines(num_points=20):
+    """
+    :return
+        points along the lines of the court reference with shape (num_lines*num_points,1,2)
+    """
+    lines = [court_ref.baseline_top, court_ref.baseline_bottom, court_ref.left_court_line,
+             court_ref.right_court_line, court_ref.left_inner_line, court_ref.right_inner_line,
+             court_ref.middle_line, court_ref.top_inner_line, court_ref.bottom_inner_line]
+    steps = np.linspace(0, 1, num_points)[:, None]
+    points = [np.float32(start) + steps * (np.float32(end) - np.float32(start)) for start, end in lines]
+    return np.concatenate(points).reshape(-1, 1, 2).astype(np.float32)
+
+court_line_points = sample_court_lines()
 
 class CourtDetectorNet():
-    def __init__(self, path_model=None,  device='cuda'):
+    def __init__(self, path_model=None,  device='cuda', backend='torch', num_threads=None, sharp_peak=None):
+        """
+        :params
+            path_model: path to pretrained court detection weights
+            device: torch device to run the model on
+            backend: "torch" to run the model with PyTorch, "onnx" to run its ONNX export
+                with ONNX Runtime on CPU. The export is cached next to the weights.
+                "onnx-int8" runs the INT8 model calibrated with others/quantize.py,
+                "fused" runs an inference-only copy of the model with BatchNorm folded into convolutions
+            num_threads: number of threads for the onnx backends, all cores by default.
+                Torch backends follow the process-wide torch.set_num_threads
+            sharp_peak: skip refinement of keypoints whose heatmap maximum is at least sharp_peak,
+                all keypoints are refined if None
+        """
         self.model = BallTrackerNet(out_channels=15)
         self.device = device
+        self.sharp_peak = sharp_peak
+        # how many keypoints were refined on original frames, how many of them moved and how many were skipped
+        self.refine_stats = {'refined': 0, 'moved': 0, 'skipped': 0}
+        self.width = 640
+        self.height = 360
         if path_model:
             self.model.load_state_dict(torch.load(path_model, map_location=device, weights_only=True))
             self.model = self.model.to(device)
             self.model.eval()
+            if backend == 'fused':
+                self.model = fuse_tracknet(self.model)
+            elif backend == 'onnx':
+                self.model = load_onnx_model(self.model, path_model, (3, 360, 640), num_threads)
+                self.device = 'cpu'
+            elif backend == 'onnx-int8':
+                self.model = load_int8_model(path_model, num_threads)
+                self.device = 'cpu'
             
-    def infer_model(self, frames):
-        output_width = 640
-        output_height = 360
-        scale = []
-        
+    def infer_model(self, frames, batch_size=1):
+        """
+        Detect court keypoints and homography matrices in a list of frames
+        :params
+            frames: list of video frames
+            batch_size: number of frames per forward pass
+        :return
+            matrixes_res: list of homography matrices from frame to court reference or None
+            kps_res: list of 14 court keypoints projected from court reference or None
+        """
         kps_res = []
         matrixes_res = []
-        print("Ball detector processing")
-        for num_frame, image in enumerate(tqdm(frames)):
-            img = cv2.resize(image, (output_width, output_height))
-            if not scale:
-                scale.append(image.shape[0]  * 1.0 / output_height)
-                scale.append(image.shape[1]  * 1.0 / output_width)
-            inp = (img.astype(np.float32) / 255.)
-            inp = torch.tensor(np.rollaxis(inp, 2, 0))
-            inp = inp.unsqueeze(0)
-
-            out = self.model(inp.float().to(self.device))[0]
-            pred = F.sigmoid(out).detach().cpu().numpy()
-
-            points = []
-            for kps_num in range(14):
-                heatmap = (pred[kps_num]*255).astype(np.uint8)
-                ret, heatmap = cv2.threshold(heatmap, 170, 255, cv2.THRESH_BINARY)
-                circles = cv2.HoughCircles(heatmap, cv2.HOUGH_GRADIENT, dp=1, minDist=20, param1=50, param2=2,
-                                           minRadius=10, maxRadius=25)
-                if circles is not None:
-                    x_pred = circles[0][0][0]*scale[1]
-                    y_pred = circles[0][0][1]*scale[0]
-                    if kps_num not in [8, 12, 9]:
-                        x_pred, y_pred = refine_kps(image, int(y_pred), int(x_pred), crop_size=40)
-                    points.append((x_pred, y_pred))                
-                else:
-                    points.append(None)
-
-            matrix_trans = get_trans_matrix(points) 
-            points = None
-            if matrix_trans is not None:
-                points = cv2.perspectiveTransform(refer_kps, matrix_trans)
-                matrix_trans = cv2.invert(matrix_trans)[1]
+        print("Court detector processing")
+        for matrix_trans, points in self.infer_frames(((image, None) for image in tqdm(frames)), batch_size):
             kps_res.append(points)
             matrixes_res.append(matrix_trans)
             
         return matrixes_res, kps_res    
+
+    def infer_frames(self, frames, batch_size=1):
+        """
+        Detect court keypoints and homography matrices in a stream of frames, only the current batch is kept
+        :params
+            frames: iterable of (image, img) pairs, original video frame and the same frame already
+                resized to 640x360 or None to resize it here
+            batch_size: number of frames per forward pass
+        :return
+            generator of (matrix_trans, points) pairs, as returned by infer_frame
+        """
+        inp = np.empty((batch_size, 3, self.height, self.width), dtype=np.float32)
+        images = []
+        for image, img in frames:
+            inp[len(images)] = self.prepare(image, img)[0]
+            images.append(image)
+            if len(images) == batch_size:
+                yield from self.infer_batch(images, inp)
+                images = []
+        if images:
+            yield from self.infer_batch(images, inp[:len(images)])
+
+    def infer_keyframes(self, frames, interval=25, min_agreement=0.7):
+        """
+        Detect the court on keyframes only and reuse the homography in between. A frame is a keyframe
+        when it starts a new scene, when interval frames passed since the last keyframe, when the court
+        was not found on the previous frame or when the court lines drifted away from the projected ones
+        :params
+            frames: iterable of (image, img, new_scene) triples, original video frame, the same frame
+                resized to 640x360 or None and True if a scene starts at this frame
+            interval: maximum number of frames between keyframes
+            min_agreement: redetect when the share of projected line points that hit line pixels drops
+                below this part of the share on the keyframe
+        :return
+            generator of (matrix_trans, points) pairs, one per frame, as returned by infer_frame
+        """
+        matrix_trans, points = None, None
+        num_reused = 0
+        for image, img, new_scene in frames:
+            if matrix_trans is not None and not new_scene and num_reused < interval:
+                agreement = self.line_agreement(image, matrix_trans)
+                if agreement >= min_agreement * ref_agreement:
+                    num_reused += 1
+                    yield matrix_trans, points
+                    continue
+            matrix_trans, points = self.infer_frame(image, img)
+            if matrix_trans is not None:
+                ref_agreement = self.line_agreement(image, matrix_trans)
+            num_reused = 0
+            yield matrix_trans, points
+
+    def line_agreement(self, image, matrix_trans, threshold=155):
+        """
+        Cheap check of a homography: project points of the court lines to the frame and count
+        how many of them lie on bright pixels
+        :params
+            image: original video frame
+            matrix_trans: homography matrix from frame to court reference
+            threshold: minimum gray level of line pixels, the same as in refine_kps
+        :return
+            share of projected points inside the frame that hit line pixels
+        """
+        pts = cv2.perspectiveTransform(court_line_points, cv2.invert(matrix_trans)[1]).reshape(-1, 2)
+        pts = np.round(pts).astype(int)
+        height, width = image.shape[:2]
+        inside = (pts[:, 0] >= 2) & (pts[:, 0] < width - 2) & (pts[:, 1] >= 2) & (pts[:, 1] < height - 2)
+        if not inside.any():
+            return 0.0
+        xs, ys = pts[inside, 0], pts[inside, 1]
+        # lines are a few pixels wide and the projection is not exact, so a small neighbourhood is checked
+        hits = np.zeros(len(xs), dtype=bool)
+        for dx, dy in [(0, 0), (-2, 0), (2, 0), (0, -2), (0, 2)]:
+            pixels = image[ys + dy, xs + dx].astype(np.float32)
+            gray = pixels @ np.float32([0.114, 0.587, 0.299])
+            hits |= gray > threshold
+        return hits.mean()
+
+    def infer_frame(self, image, img=None):
+        """
+        Detect court keypoints and homography matrix in a single frame
+        :params
+            image: original video frame
+            img: the same frame already resized to 640x360, resized here if not given
+        :return
+            matrix_trans: homography matrix from frame to court reference or None
+            points: 14 court keypoints projected from court reference or None
+        """
+        return next(self.infer_frames([(image, img)]))
+
+    def infer_batch(self, images, inp):
+        """
+        :params
+            images: list of original video frames
+            inp: network input for these frames with shape (batch,3,360,640)
+        :return
+            list of (matrix_trans, points) pairs, one per frame
+        """
+        with torch.inference_mode():
+            out = self.model(torch.from_numpy(inp).to(self.device))
+            pred = F.sigmoid(out[:, :14]).cpu().numpy()
+
+        kps = self.find_circles(pred)
+        peaks = pred.reshape(len(pred), 14, -1).max(axis=2) if self.sharp_peak is not None else None
+        return self.postprocess(images, kps, peaks)
+
+    def find_circles(self, heatmaps, margin=32):
+        """
+        Find keypoints in the heatmaps of a batch with cv2.HoughCircles. All heatmaps are thresholded
+        at once, heatmaps without pixels above the threshold are skipped and HoughCircles only runs
+        on the bounding box of the thresholded pixels grown by margin. Circle centers vote at most
+        maxRadius pixels away from the edges, so the circles are the same as on the whole heatmap
+        :params
+            heatmaps: keypoint heatmaps with shape (batch,14,360,640)
+            margin: pixels added around the thresholded pixels, more than maxRadius
+        :return
+            list with 14 x,y keypoints in heatmap pixels or None per frame
+        """
+        batch, num_kps, height, width = heatmaps.shape
+        heatmaps = heatmaps.reshape(batch * num_kps, height, width)
+        # (heatmap * 255).astype(np.uint8) thresholded above 170 is the same as heatmap * 255 >= 171
+        masks = heatmaps * np.float32(255) >= 171
+        rows = masks.any(axis=2)
+        cols = masks.any(axis=1)
+        kps = []
+        for mask, row, col in zip(masks, rows, cols):
+            ys = np.flatnonzero(row)
+            xs = np.flatnonzero(col)
+            if len(ys) == 0:
+                kps.append(None)
+                continue
+            y_min, y_max = max(ys[0] - margin, 0), min(ys[-1] + margin + 1, height)
+            x_min, x_max = max(xs[0] - margin, 0), min(xs[-1] + margin + 1, width)
+            heatmap = mask[y_min:y_max, x_min:x_max].astype(np.uint8) * 255
+            circles = cv2.HoughCircles(heatmap, cv2.HOUGH_GRADIENT, dp=1, minDist=20, param1=50, param2=2,
+                                       minRadius=10, maxRadius=25)
+            if circles is not None:
+                kps.append((np.float32(circles[0][0][0] + x_min), np.float32(circles[0][0][1] + y_min)))
+            else:
+                kps.append(None)
+        return [kps[num:num + num_kps] for num in range(0, len(kps), num_kps)]
+
+    def postprocess(self, images, kps, peaks=None):
+        """
+        Refine keypoints of a batch of frames on the original frames and fit the court reference to them
+        :params
+            images: list of original video frames
+            kps: list with 14 x,y keypoints in heatmap pixels or None per frame
+            peaks: array with shape (batch,14) of heatmap maxima, used to skip refinement of sharp keypoints
+        :return
+            list of (matrix_trans, points) pairs, one per frame
+        """
+        points = []
+        to_refine = []
+        for num, image in enumerate(images):
+            scale = (image.shape[0] * 1.0 / self.height, image.shape[1] * 1.0 / self.width)
+            frame_points = []
+            frame_refine = []
+            for kps_num, kp in enumerate(kps[num]):
+                point = None
+                if kp is not None:
+                    point = (kp[0]*scale[1], kp[1]*scale[0])
+                refine = point is not None and kps_num not in [8, 12, 9]
+                if refine and peaks is not None and peaks[num, kps_num] >= self.sharp_peak:
+                    self.refine_stats['skipped'] += 1
+                    refine = False
+                frame_points.append(point)
+                frame_refine.append(point if refine else None)
+            points.append(frame_points)
+            to_refine.append(frame_refine)
+
+        refined, stats = refine_kps_batch(images, to_refine, crop_size=40)
+        self.refine_stats['refined'] += stats['refined']
+        self.refine_stats['moved'] += stats['moved']
+        points = [[r if r is not None else p for p, r in zip(frame_points, frame_refined)]
+                  for frame_points, frame_refined in zip(points, refined)]
+        return [self.fit_court(matrix_trans) for matrix_trans in get_trans_matrices(points)]
+
+    def fit_court(self, matrix_trans):
+        """
+        :params
+            matrix_trans: homography matrix from court reference to frame or None
+        :return
+            matrix_trans: homography matrix from frame to court reference or None
+            points: 14 court keypoints projected from court reference or None
+        """
+        points = None
+        if matrix_trans is not None:
+            points = cv2.perspectiveTransform(refer_kps, matrix_trans)
+            matrix_trans = cv2.invert(matrix_trans)[1]
+        return matrix_trans, points
+
+    def prepare(self, image, img=None):
+        """
+        Convert a frame to the network input
+        :params
+            image: original video frame
+            img: the same frame already resized to 640x360, resized here if not given
+        :return
+            array with shape (1,3,360,640)
+        """
+        if img is None:
+            img = cv2.resize(image, (self.width, self.height))
+        inp = (img.astype(np.float32) / 255.)
+        inp = np.rollaxis(inp, 2, 0)
+        return np.expand_dims(inp, axis=0)
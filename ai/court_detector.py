@@ -1,9 +1,13 @@
 import numpy as np
 import cv2
 from matplotlib import pyplot as plt
-from sympy import Line
 from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from pickle_court_reference import CourtReference
+from geometry import (intersect_lines, line_intersection, sort_intersection_points, solve_homographies,
+                      merge_horizontal_lines, merge_vertical_lines)
+import os
 import scipy.signal as sp
 
 
@@ -12,8 +16,15 @@ class CourtDetector:
     Detecting and tracking court in frame
     """
 
-    def __init__(self, verbose=0):
+    def __init__(self, verbose=0, num_threads=None, max_history=100):
+        """
+        :params
+            verbose: show intermediate results of court detection
+            num_threads: number of threads scoring candidate homographies, all cores by default
+            max_history: number of last court_warp_matrix and game_warp_matrix matrices to keep
+        """
         self.verbose = verbose
+        self.num_threads = num_threads or os.cpu_count()
         self.colour_threshold = 200
         self.dist_tau = 3
         self.intensity_threshold = 40
@@ -22,8 +33,8 @@ class CourtDetector:
         self.v_height = 0
         self.frame = None
         self.gray = None
-        self.court_warp_matrix = []
-        self.game_warp_matrix = []
+        self.court_warp_matrix = deque(maxlen=max_history)
+        self.game_warp_matrix = deque(maxlen=max_history)
         self.court_score = 0
         self.baseline_top = None
         self.baseline_bottom = None
@@ -40,7 +51,18 @@ class CourtDetector:
         self.success_score = 1000
         self.best_conf = None
         self.frame_points = None
-        self.dist = 5
+        # search distance of court tracking, widened while lines are lost
+        self.start_dist = 5
+        self.dist = self.start_dist
+        # candidate homographies are ranked by a sparse score and the best ones get the full score
+        self.line_points = self._sample_court_lines(spacing=10)
+        # every line point stands for spacing x 5 pixels of the dilated court lines
+        self.line_point_area = 10 * 5
+        self.num_white_points = 4000
+        # None gives every candidate the full score, the exhaustive search without the sparse ranking
+        self.num_rescored = 10
+        # candidates scored together, the sparse score keeps arrays of chunk x num_white_points
+        self.sparse_chunk_size = 256
 
     def detect(self, frame, verbose=0):
         """
@@ -55,9 +77,10 @@ class CourtDetector:
         # Filter pixel using the court known structure
         filtered = self._filter_pixels(self.gray)
 
-        cv2.imshow("filtered", filtered)
-        if cv2.waitKey(0):
-            cv2.destroyAllWindows()
+        if self.verbose:
+            cv2.imshow("filtered", filtered)
+            if cv2.waitKey(0):
+                cv2.destroyAllWindows()
 
         # Detect lines using Hough transform
         horizontal_lines, vertical_lines = self._detect_lines(filtered)
@@ -68,6 +91,10 @@ class CourtDetector:
         )
         self.court_warp_matrix.append(court_warp_matrix)
         self.game_warp_matrix.append(game_warp_matrix)
+        # tracking starts again from the configuration of the new detection
+        self.frame_points = None
+        if court_warp_matrix is not None:
+            self.dist = self.start_dist
         # court_accuracy = self._get_court_accuracy(0)
         # if court_accuracy > self.success_accuracy and self.court_score > self.success_score:
         #   self.success_flag = True
@@ -85,48 +112,63 @@ class CourtDetector:
 
     def _filter_pixels(self, gray):
         """
-        Filter pixels by using the court line structure
-        """
-        for i in range(self.dist_tau, len(gray) - self.dist_tau):
-            for j in range(self.dist_tau, len(gray[0]) - self.dist_tau):
-                if gray[i, j] == 0:
-                    continue
-                if (
-                    gray[i, j] - gray[i + self.dist_tau, j] > self.intensity_threshold
-                    and gray[i, j] - gray[i - self.dist_tau, j]
-                    > self.intensity_threshold
-                ):
-                    continue
-                if (
-                    gray[i, j] - gray[i, j + self.dist_tau] > self.intensity_threshold
-                    and gray[i, j] - gray[i, j - self.dist_tau]
-                    > self.intensity_threshold
-                ):
-                    continue
-                gray[i, j] = 0
-        return gray
-
-    def _filter_pixels(self, gray):
+        Filter pixels by using the court line structure. A white pixel is kept when it is brighter than both
+        pixels dist_tau above and below it or both pixels dist_tau left and right of it. Pixels are filtered in
+        place in raster order, so the pixels above and on the left are compared after they were filtered.
+        Inside a row every pixel depends on the pixel dist_tau to its left only through a keep / drop / copy /
+        invert rule, which is resolved for the whole frame with cumulative sums. Rows are filtered against the
+        previous result for the rows above until nothing changes, which gives the raster order result because
+        it is the only one satisfying all comparisons. Only the rows below rows changed by a pass are filtered
+        again, and on court frames a few passes are enough
         """
-        Filter pixels by using the court line structure
-        """
-        for i in range(self.dist_tau, len(gray) - self.dist_tau):
-            for j in range(self.dist_tau, len(gray[0]) - self.dist_tau):
-                if gray[i, j] == 0:
-                    continue
-                if (
-                    gray[i, j] - gray[i + self.dist_tau, j] > self.intensity_threshold
-                    and gray[i, j] - gray[i - self.dist_tau, j]
-                    > self.intensity_threshold
-                ):
-                    continue
-                if (
-                    gray[i, j] - gray[i, j + self.dist_tau] > self.intensity_threshold
-                    and gray[i, j] - gray[i, j - self.dist_tau]
-                    > self.intensity_threshold
-                ):
-                    continue
-                gray[i, j] = 0
+        d = self.dist_tau
+        height, width = gray.shape[:2]
+        if height <= 2 * d or width <= 2 * d:
+            return gray
+
+        def brighter(a, b):
+            # uint8 differences wrap around like the subtraction of numpy scalars did
+            return a - b > self.intensity_threshold
+
+        def chains(a):
+            # (rows, steps, d) view where every pixel follows the pixel dist_tau to its left
+            a = np.pad(a, ((0, 0), (0, steps * d - a.shape[1])))
+            return a.reshape(len(a), steps, d)
+
+        steps = -(-(width - 2 * d) // d)
+        center = gray[d:height - d, d:width - d]
+        nonzero = chains(center != 0)
+        below = chains(brighter(center, gray[2 * d:, d:width - d]))
+        right = brighter(center, gray[d:height - d, 2 * d:])
+        # the result if the pixel on the left was kept and if it was set to 0
+        if_kept = chains(right & brighter(center, gray[d:height - d, :width - 2 * d]))
+        if_dropped = chains(right & (center > self.intensity_threshold))
+        same = if_kept == if_dropped
+        step = np.arange(steps, dtype=np.int16)[None, :, None]
+
+        filtered = center.copy()
+        rows = np.arange(len(center))
+        while len(rows):
+            # the first rows are compared with rows outside of the filtered area
+            above = np.concatenate([gray[:d, d:width - d], filtered])[rows]
+            vertical = chains(brighter(center[rows], above)) & below[rows]
+            is_const = ~nonzero[rows] | vertical | same[rows]
+            const_value = nonzero[rows] & (vertical | if_kept[rows])
+            is_not = ~is_const & if_dropped[rows]
+            # a pixel after the last rule that keeps or drops it regardless of its left neighbour is that result
+            # inverted once for every invert rule since, this result is carried along the row with a running maximum
+            # of step * 2 + result xor the parity of invert rules. The first pixels of a row are compared with
+            # unfiltered pixels as if they were kept, which -1 encodes
+            odd_not = np.logical_xor.accumulate(is_not, axis=1)
+            code = np.where(is_const, step * 2 + (const_value ^ odd_not), np.int16(-1))
+            value = (np.maximum.accumulate(code, axis=1) & 1).astype(bool)
+            keep = (value ^ odd_not).reshape(len(rows), -1)[:, :width - 2 * d]
+            result = np.where(keep, center[rows], 0).astype(gray.dtype)
+            changed = rows[(result != filtered[rows]).any(axis=1)]
+            filtered[rows] = result
+            # only rows below changed rows can change in the next pass
+            rows = changed[changed + d < len(center)] + d
+        center[...] = filtered
         return gray
 
     def _detect_lines(self, gray):
@@ -212,102 +254,57 @@ class CourtDetector:
         Merge lines that belongs to the same frame`s lines
         """
 
-        # Merge horizontal lines
-        horizontal_lines = sorted(horizontal_lines, key=lambda item: item[0])
-        mask = [True] * len(horizontal_lines)
-        new_horizontal_lines = []
-        for i, line in enumerate(horizontal_lines):
-            if mask[i]:
-                for j, s_line in enumerate(horizontal_lines[i + 1 :]):
-                    if mask[i + j + 1]:
-                        x1, y1, x2, y2 = line
-                        x3, y3, x4, y4 = s_line
-                        dy = abs(y3 - y2)
-                        if dy < 10:
-                            points = sorted(
-                                [(x1, y1), (x2, y2), (x3, y3), (x4, y4)],
-                                key=lambda x: x[0],
-                            )
-                            line = np.array([*points[0], *points[-1]])
-                            mask[i + j + 1] = False
-                new_horizontal_lines.append(line)
-
-        # Merge vertical lines
-        vertical_lines = sorted(vertical_lines, key=lambda item: item[1])
-        xl, yl, xr, yr = (0, self.v_height * 6 / 7, self.v_width, self.v_height * 6 / 7)
-        mask = [True] * len(vertical_lines)
-        new_vertical_lines = []
-        for i, line in enumerate(vertical_lines):
-            if mask[i]:
-                for j, s_line in enumerate(vertical_lines[i + 1 :]):
-                    if mask[i + j + 1]:
-                        x1, y1, x2, y2 = line
-                        x3, y3, x4, y4 = s_line
-                        xi, yi = line_intersection(
-                            ((x1, y1), (x2, y2)), ((xl, yl), (xr, yr))
-                        )
-                        xj, yj = line_intersection(
-                            ((x3, y3), (x4, y4)), ((xl, yl), (xr, yr))
-                        )
-
-                        dx = abs(xi - xj)
-                        if dx < 10:
-                            points = sorted(
-                                [(x1, y1), (x2, y2), (x3, y3), (x4, y4)],
-                                key=lambda x: x[1],
-                            )
-                            line = np.array([*points[0], *points[-1]])
-                            mask[i + j + 1] = False
-
-                new_vertical_lines.append(line)
+        new_horizontal_lines = merge_horizontal_lines(horizontal_lines)
+        new_vertical_lines = merge_vertical_lines(vertical_lines, self.v_height, self.v_width)
         return new_horizontal_lines, new_vertical_lines
 
     def _find_homography(self, horizontal_lines, vertical_lines):
         """
-        Finds transformation from reference court to frame`s court using 4 pairs of matching points
+        Finds transformation from reference court to frame`s court using 4 pairs of matching points.
+        Every pair of horizontal lines and pair of vertical lines gives 4 intersection points, which are matched
+        with every court configuration. Impossible candidates are rejected by geometry, the rest are ranked
+        by a sparse estimate of the score in parallel and only the best ones are scored with the full court warp.
+        The ranking is an approximation, with num_rescored set to None every candidate gets the full score
         """
         max_score = -np.inf
         max_mat = None
         max_inv_mat = None
-        k = 0
-        # Loop over every pair of horizontal lines and every pair of vertical lines
-        for horizontal_pair in list(combinations(horizontal_lines, 2)):
-            for vertical_pair in list(combinations(vertical_lines, 2)):
-                h1, h2 = horizontal_pair
-                v1, v2 = vertical_pair
-                # Finding intersection points of all lines
-                i1 = line_intersection(
-                    (tuple(h1[:2]), tuple(h1[2:])), (tuple(v1[0:2]), tuple(v1[2:]))
-                )
-                i2 = line_intersection(
-                    (tuple(h1[:2]), tuple(h1[2:])), (tuple(v2[0:2]), tuple(v2[2:]))
-                )
-                i3 = line_intersection(
-                    (tuple(h2[:2]), tuple(h2[2:])), (tuple(v1[0:2]), tuple(v1[2:]))
-                )
-                i4 = line_intersection(
-                    (tuple(h2[:2]), tuple(h2[2:])), (tuple(v2[0:2]), tuple(v2[2:]))
-                )
-
-                intersections = [i1, i2, i3, i4]
-                intersections = sort_intersection_points(intersections)
-
-                for i, configuration in self.court_reference.court_conf.items():
-                    # Find transformation
-                    matrix, _ = cv2.findHomography(
-                        np.float32(configuration), np.float32(intersections), method=0
-                    )
-                    inv_matrix = cv2.invert(matrix)[1]
-                    # Get transformation score
-                    confi_score = self._get_confi_score(matrix)
-
-                    if max_score < confi_score:
-                        max_score = confi_score
-                        max_mat = matrix
-                        max_inv_mat = inv_matrix
-                        self.best_conf = i
-
-                    k += 1
+        horizontal_pairs = np.array(list(combinations(horizontal_lines, 2))).reshape(-1, 2, 1, 4)
+        vertical_pairs = np.array(list(combinations(vertical_lines, 2))).reshape(-1, 1, 2, 4)
+        # Finding intersection points of every pair of horizontal lines with every pair of vertical lines,
+        # in the order h1v1, h1v2, h2v1, h2v2
+        all_intersections = intersect_lines(horizontal_pairs[:, None], vertical_pairs[None, :])
+        all_intersections = sort_intersection_points(all_intersections.reshape(-1, 4, 2))
+        all_intersections = all_intersections[self._valid_quadrilaterals(all_intersections)]
+
+        # candidate k matches the intersections k // 12 with the configuration k % 12, like the loop it replaces
+        conf_ids = np.array(list(self.court_reference.court_conf.keys()))
+        configurations = np.array([self.court_reference.court_conf[i] for i in conf_ids], dtype=np.float64)
+        matrices = solve_homographies(np.tile(configurations, (len(all_intersections), 1, 1)),
+                                      np.repeat(all_intersections, len(conf_ids), axis=0))
+        candidates = np.flatnonzero(self._in_front_of_camera(matrices))
+
+        if len(candidates):
+            ys, xs = np.nonzero(self.gray)
+            step = max(1, len(xs) // self.num_white_points)
+            white_points = np.stack([xs[::step], ys[::step], np.ones(len(xs[::step]))], axis=1).astype(np.float64)
+            white_scale = len(xs) / max(len(white_points), 1)
+            with ThreadPoolExecutor(self.num_threads) as executor:
+                if self.num_rescored is None:
+                    best = candidates
+                else:
+                    chunks = np.array_split(candidates, int(np.ceil(len(candidates) / self.sparse_chunk_size)))
+                    sparse_scores = np.concatenate(list(executor.map(
+                        lambda chunk: self._get_sparse_score(matrices[chunk], white_points, white_scale), chunks)))
+                    # stable sort keeps the earlier candidate first among equal ranks
+                    best = np.sort(candidates[np.argsort(-sparse_scores, kind='stable')[:self.num_rescored]])
+                scores = list(executor.map(self._get_confi_score, matrices[best]))
+            # the first candidate with the highest score wins, as in the loop over all candidates
+            num = int(np.argmax(scores))
+            max_score = scores[num]
+            max_mat = matrices[best[num]]
+            max_inv_mat = cv2.invert(max_mat)[1]
+            self.best_conf = int(conf_ids[best[num] % len(conf_ids)])
 
         if self.verbose:
             frame = self.frame.copy()
@@ -316,10 +313,94 @@ class CourtDetector:
             if cv2.waitKey(0) & 0xFF == 27:
                 cv2.destroyAllWindows()
         # print(f'Score = {max_score}')
-        # print(f'Combinations tested = {k}')
+        # print(f'Combinations tested = {len(candidates)}')
 
         return max_mat, max_inv_mat, max_score
 
+    def _valid_quadrilaterals(self, intersections, min_area=100):
+        """
+        Check that intersection points can be the corners of a rectangle of the court, they have to form
+        a convex quadrilateral that is not too small or far away from the frame
+        :params
+            intersections: array with shape (n,4,2) of sorted intersection points
+            min_area: minimum area of the quadrilateral in pixels
+        :return
+            boolean array with shape (n,)
+        """
+        # corners in the order around the quadrilateral: top left, top right, bottom right, bottom left
+        corners = intersections[:, [0, 1, 3, 2]]
+        edges = np.roll(corners, -1, axis=1) - corners
+        cross = edges[:, :, 0] * np.roll(edges[:, :, 1], -1, axis=1) - \
+            edges[:, :, 1] * np.roll(edges[:, :, 0], -1, axis=1)
+        x, y = corners[:, :, 0], corners[:, :, 1]
+        area = 0.5 * np.abs((x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y).sum(axis=1))
+        with np.errstate(invalid='ignore'):
+            convex = (cross > 0).all(axis=1) | (cross < 0).all(axis=1)
+            near = (np.abs(x - self.v_width / 2) < self.v_width * 1.5).all(axis=1) & \
+                (np.abs(y - self.v_height / 2) < self.v_height * 1.5).all(axis=1)
+            return convex & near & (area > min_area)
+
+    def _in_front_of_camera(self, matrices):
+        """
+        Check that the whole court is on one side of the horizon of the homography, otherwise the
+        court would be projected through infinity
+        :params
+            matrices: array with shape (n,3,3) of homographies from court reference to frame
+        :return
+            boolean array with shape (n,)
+        """
+        border = np.concatenate([np.float64(self.court_reference.border_points), np.ones((4, 1))], axis=1)
+        w = np.einsum('nj,kj->kn', border, matrices[:, 2])
+        return (w > 0).all(axis=1) | (w < 0).all(axis=1)
+
+    def _sample_court_lines(self, spacing):
+        """
+        Points along the lines of the court reference, one every spacing pixels
+        """
+        ref = self.court_reference
+        lines = [ref.baseline_top, ref.baseline_bottom, ref.net, ref.top_inner_line, ref.bottom_inner_line,
+                 ref.left_court_line, ref.right_court_line, ref.left_inner_line, ref.right_inner_line,
+                 ref.middle_line]
+        points = []
+        for start, end in lines:
+            start, end = np.float64(start), np.float64(end)
+            steps = np.linspace(0, 1, int(np.linalg.norm(end - start) // spacing) + 1)[:, None]
+            points.append(start + steps * (end - start))
+        points = np.concatenate(points)
+        return np.concatenate([points, np.ones((len(points), 1))], axis=1)
+
+    def _get_sparse_score(self, matrices, white_points, white_scale):
+        """
+        Approximate transformation score of several homographies without warping the reference court.
+        Correct pixels are white pixels whose position on the court reference is on a court line, like
+        cv2.warpPerspective looks them up. All court pixels are the area of the court lines on frame, from
+        the scale of the homography at the court line points
+        :params
+            matrices: array with shape (n,3,3) of homographies from court reference to frame
+            white_points: array with shape (m,3) of homogeneous coordinates of white pixels
+            white_scale: number of white pixels each of white_points stands for
+        :return
+            array with shape (n,) of scores
+        """
+        court = self.court_reference.court
+        ref_points = np.einsum('kij,mj->kmi', np.linalg.inv(matrices), white_points)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = np.floor(ref_points[..., 0] / ref_points[..., 2] + 0.5)
+            y = np.floor(ref_points[..., 1] / ref_points[..., 2] + 0.5)
+        inside = (x >= 0) & (x < court.shape[1]) & (y >= 0) & (y < court.shape[0])
+        on_line = court[np.where(inside, y, 0).astype(np.intp), np.where(inside, x, 0).astype(np.intp)] > 0
+        correct = (on_line & inside).sum(axis=1) * white_scale
+
+        # the jacobian determinant of a homography is det(H) / w^3
+        projected = np.einsum('kij,nj->kni', matrices, self.line_points)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            area = np.abs(np.linalg.det(matrices))[:, None] / np.abs(projected[..., 2]) ** 3 * self.line_point_area
+            x = projected[..., 0] / projected[..., 2]
+            y = projected[..., 1] / projected[..., 2]
+            on_frame = (x >= -0.5) & (x < self.v_width - 0.5) & (y >= -0.5) & (y < self.v_height - 0.5)
+        total = np.where(on_frame, area, 0).sum(axis=1)
+        return correct - 0.5 * (total - correct)
+
     def _get_confi_score(self, matrix):
         """
         Calculate transformation score
@@ -424,9 +505,11 @@ class CourtDetector:
 
     def track_court(self, frame):
         """
-        Track court location after detection
+        Track court location after detection. The lines of the best configuration are searched near their
+        location in the previous frame, the search distance grows by 5 pixels every time a line is lost
+        and the court is detected again once it is more than 20 pixels. It starts from start_dist again
+        after the lines are found or the court is detected
         """
-        copy = frame.copy()
         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         if self.frame_points is None:
             conf_points = np.array(
@@ -437,103 +520,19 @@ class CourtDetector:
                 .squeeze()
                 .round()
             )
-        # Lines of configuration on frames
-        line1 = self.frame_points[:2]
-        line2 = self.frame_points[2:4]
-        line3 = self.frame_points[[0, 2]]
-        line4 = self.frame_points[[1, 3]]
-        lines = [line1, line2, line3, line4]
-        new_lines = []
-        # print(lines)
-        for line in lines:
-            # Get 100 samples of each line in the frame
-            points_on_line = np.linspace(line[0], line[1], 102)[
-                1:-1
-            ]  # 100 samples on the line
-            p1 = None
-            p2 = None
-            if (
-                line[0][0] > self.v_width
-                or line[0][0] < 0
-                or line[0][1] > self.v_height
-                or line[0][1] < 0
-            ):
-                for p in points_on_line:
-                    if 0 < p[0] < self.v_width and 0 < p[1] < self.v_height:
-                        p1 = p
-                        break
-            if (
-                line[1][0] > self.v_width
-                or line[1][0] < 0
-                or line[1][1] > self.v_height
-                or line[1][1] < 0
-            ):
-                for p in reversed(points_on_line):
-                    if 0 < p[0] < self.v_width and 0 < p[1] < self.v_height:
-                        p2 = p
-                        break
-            # if one of the ends of the line is out of the frame get only the points inside the frame
-            if p1 is not None or p2 is not None:
-                print("points outside screen")
-                points_on_line = np.linspace(
-                    p1 if p1 is not None else line[0],
-                    p2 if p2 is not None else line[1],
-                    102,
-                )[1:-1]
-
-            new_points = []
-            # Find max intensity pixel near each point
-            for p in points_on_line:
-                p = (int(round(p[0])), int(round(p[1])))
-                top_y, top_x = max(p[1] - self.dist, 0), max(p[0] - self.dist, 0)
-                bottom_y, bottom_x = min(p[1] + self.dist, self.v_height), min(
-                    p[0] + self.dist, self.v_width
-                )
-                patch = gray[top_y:bottom_y, top_x:bottom_x]
-                y, x = np.unravel_index(np.argmax(patch), patch.shape)
-                if patch[y, x] > 150:
-                    new_p = (x + top_x + 1, y + top_y + 1)
-                    new_points.append(new_p)
-                    cv2.circle(copy, p, 1, (255, 0, 0), 1)
-                    cv2.circle(copy, new_p, 1, (0, 0, 255), 1)
-            new_points = np.array(new_points, dtype=np.float32).reshape((-1, 1, 2))
-            # find line fitting the new points
-            [vx, vy, x, y] = cv2.fitLine(new_points, cv2.DIST_L2, 0, 0.01, 0.01)
-            new_lines.append(
-                (
-                    (int(x - vx * self.v_width), int(y - vy * self.v_width)),
-                    (int(x + vx * self.v_width), int(y + vy * self.v_width)),
-                )
-            )
-            # print('REACHED HEREEEEEEEEEEEEEEEEEEEEEEEEEEEE ', len(new_points))
+        while True:
+            new_lines = self._track_lines(frame, gray)
+            if new_lines is not None:
+                break
             # if less than 50 points were found detect court from the start instead of tracking
-            if len(new_points) < 50:
-                print("CAMERA ...", end=" ")
-                if self.dist > 20:
-                    print("HAS BEEN MOVED")
-                    # cv2.imshow('court', copy)
-                    # if cv2.waitKey(0) & 0xff == 27:
-                    # cv2.destroyAllWindows()
-                    return self.detect(frame)
-                    conf_points = np.array(
-                        self.court_reference.court_conf[self.best_conf],
-                        dtype=np.float32,
-                    ).reshape((-1, 1, 2))
-                    self.frame_points = (
-                        cv2.perspectiveTransform(
-                            conf_points, self.court_warp_matrix[-1]
-                        )
-                        .squeeze()
-                        .round()
-                    )
-
-                    print("Smaller than 50")
-                    return
-                else:
-                    print("Court tracking failed, adding 5 pixels to dist")
-                    self.dist += 5
-                    # print(self.b)
-                    return self.track_court(frame)
+            print("CAMERA ...", end=" ")
+            if self.dist > 20:
+                print("HAS BEEN MOVED")
+                return self.detect(frame, self.verbose)
+            print("Court tracking failed, adding 5 pixels to dist")
+            self.dist += 5
+        self.dist = self.start_dist
+
         # Find transformation from new lines
         i1 = line_intersection(new_lines[0], new_lines[2])
         i2 = line_intersection(new_lines[0], new_lines[3])
@@ -557,28 +556,86 @@ class CourtDetector:
         ).reshape(-1)
         return self.new_lines
 
+    def _track_lines(self, frame, gray):
+        """
+        Find the 4 lines of the configuration near their previous location. 100 points are sampled on every
+        line and moved to the brightest pixel within self.dist of them, the patches around all points
+        are taken from the frame at once
+        :params
+            frame: video frame
+            gray: the frame in grayscale
+        :return
+            4 lines given by two points each or None if less than 50 points of a line were found
+        """
+        # Lines of configuration on frames
+        line1 = self.frame_points[:2]
+        line2 = self.frame_points[2:4]
+        line3 = self.frame_points[[0, 2]]
+        line4 = self.frame_points[[1, 3]]
+        lines = [line1, line2, line3, line4]
+        points = np.round(np.stack([self._points_on_line(line) for line in lines])).astype(int)
+
+        # patches of 2*dist x 2*dist pixels with their top left corner dist pixels above and left of the points.
+        # Pixels outside the frame are -1, so the first maximum of a patch is the first maximum of its part
+        # inside the frame, as with the patches clipped to the frame
+        dist = self.dist
+        padded = np.pad(gray.astype(np.int16), 2 * dist, constant_values=-1)
+        windows = np.lib.stride_tricks.sliding_window_view(padded, (2 * dist, 2 * dist))
+        xs, ys = points[..., 0], points[..., 1]
+        # patches of points more than dist pixels out of the frame are empty
+        valid = (xs >= -dist) & (xs <= self.v_width + dist) & (ys >= -dist) & (ys <= self.v_height + dist)
+        patches = windows[np.where(valid, ys + dist, 0), np.where(valid, xs + dist, 0)]
+        patches = patches.reshape(*points.shape[:2], -1)
+        max_ind = patches.argmax(axis=2)
+        found = (np.take_along_axis(patches, max_ind[..., None], axis=2)[..., 0] > 150) & valid
+        new_points = np.stack([xs - dist + max_ind % (2 * dist) + 1, ys - dist + max_ind // (2 * dist) + 1], axis=2)
 
-def line_intersection(line1, line2):
-    """
-    Find 2 lines intersection point
-    """
-    l1 = Line(line1[0], line1[1])
-    l2 = Line(line2[0], line2[1])
-
-    intersection = l1.intersection(l2)
-    return intersection[0].coordinates
+        if self.verbose:
+            copy = frame.copy()
+            for p, new_p in zip(points[found], new_points[found]):
+                cv2.circle(copy, tuple(map(int, p)), 1, (255, 0, 0), 1)
+                cv2.circle(copy, tuple(map(int, new_p)), 1, (0, 0, 255), 1)
+            cv2.imshow("court tracking", copy)
+            cv2.waitKey(1)
 
+        new_lines = []
+        for line_points, line_found in zip(new_points, found):
+            if line_found.sum() < 50:
+                return None
+            # find line fitting the new points
+            vx, vy, x, y = cv2.fitLine(
+                np.float32(line_points[line_found]).reshape((-1, 1, 2)), cv2.DIST_L2, 0, 0.01, 0.01
+            ).ravel()
+            new_lines.append(
+                (
+                    (int(x - vx * self.v_width), int(y - vy * self.v_width)),
+                    (int(x + vx * self.v_width), int(y + vy * self.v_width)),
+                )
+            )
+        return new_lines
 
-def sort_intersection_points(intersections):
-    """
-    sort intersection points from top left to bottom right
-    """
-    y_sorted = sorted(intersections, key=lambda x: x[1])
-    p12 = y_sorted[:2]
-    p34 = y_sorted[2:]
-    p12 = sorted(p12, key=lambda x: x[0])
-    p34 = sorted(p34, key=lambda x: x[0])
-    return p12 + p34
+    def _points_on_line(self, line):
+        """
+        Get 100 samples of a line in the frame, if one of the ends of the line is out of the frame
+        the samples are taken between the first and the last points inside the frame
+        """
+        points_on_line = np.linspace(line[0], line[1], 102)[1:-1]
+        inside = (0 < points_on_line[:, 0]) & (points_on_line[:, 0] < self.v_width) & \
+            (0 < points_on_line[:, 1]) & (points_on_line[:, 1] < self.v_height)
+
+        def outside(p):
+            return p[0] > self.v_width or p[0] < 0 or p[1] > self.v_height or p[1] < 0
+
+        p1 = points_on_line[inside.argmax()] if outside(line[0]) and inside.any() else None
+        p2 = points_on_line[len(inside) - 1 - inside[::-1].argmax()] if outside(line[1]) and inside.any() else None
+        if p1 is not None or p2 is not None:
+            print("points outside screen")
+            points_on_line = np.linspace(
+                p1 if p1 is not None else line[0],
+                p2 if p2 is not None else line[1],
+                102,
+            )[1:-1]
+        return points_on_line
 
 
 def display_lines_on_frame(frame, horizontal=(), vertical=()):
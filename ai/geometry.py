@@ -0,0 +1,210 @@
+import numpy as np
+
+
+def intersect_lines(lines1, lines2):
+    """
+    Find intersection points of pairs of lines given by two points each
+    :params
+        lines1: array with shape (..., 4) of x1,y1,x2,y2 points of the first lines
+        lines2: array with shape (..., 4) of x1,y1,x2,y2 points of the second lines,
+            broadcastable with lines1
+    :return
+        array with shape (..., 2) of x,y intersection points, nan for parallel lines
+    """
+    lines1 = np.asarray(lines1, dtype=np.float64)
+    lines2 = np.asarray(lines2, dtype=np.float64)
+    x1, y1, x2, y2 = np.moveaxis(lines1, -1, 0)
+    x3, y3, x4, y4 = np.moveaxis(lines2, -1, 0)
+    # for integer coordinates every product below is exact, so the only rounding happens
+    # in the final division and truncating the result gives the same pixel as exact arithmetic
+    denom = (x1 - x2) * (y3 - y4) - (y1 - y2) * (x3 - x4)
+    det1 = x1 * y2 - y1 * x2
+    det2 = x3 * y4 - y3 * x4
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (det1 * (x3 - x4) - (x1 - x2) * det2) / denom
+        y = (det1 * (y3 - y4) - (y1 - y2) * det2) / denom
+    points = np.stack([x, y], axis=-1)
+    points[denom == 0] = np.nan
+    return points
+
+
+def line_intersection(line1, line2):
+    """
+    Find 2 lines intersection point
+    :params
+        line1: two points ((x1,y1),(x2,y2)) of the first line
+        line2: two points ((x1,y1),(x2,y2)) of the second line
+    :return
+        x,y intersection point or None for parallel lines
+    """
+    point = intersect_lines(np.ravel(line1), np.ravel(line2))
+    if np.isnan(point[0]):
+        return None
+    return point[0], point[1]
+
+
+def sort_intersection_points(points):
+    """
+    Sort intersection points from top left to bottom right
+    :params
+        points: array with shape (..., 4, 2) of x,y points
+    :return
+        array with shape (..., 4, 2), the two upper points by x and then the two lower points by x
+    """
+    points = np.asarray(points)
+    points = np.take_along_axis(points, np.argsort(points[..., 1:], axis=-2, kind='stable'), axis=-2)
+    top = np.take_along_axis(points[..., :2, :], np.argsort(points[..., :2, :1], axis=-2, kind='stable'), axis=-2)
+    bottom = np.take_along_axis(points[..., 2:, :], np.argsort(points[..., 2:, :1], axis=-2, kind='stable'), axis=-2)
+    return np.concatenate([top, bottom], axis=-2)
+
+
+def solve_homographies(src, dst):
+    """
+    Find homographies mapping 4 source points exactly to 4 destination points,
+    with the direct linear transform on normalized points
+    :params
+        src: array with shape (k,4,2) of source points
+        dst: array with shape (k,4,2) of destination points
+    :return
+        array with shape (k,3,3) of homography matrices normalized to H[2,2] = 1
+    """
+    src_t = _normalization(src)
+    dst_t = _normalization(dst)
+    src_n = _apply_similarity(src_t, src)
+    dst_n = _apply_similarity(dst_t, dst)
+    x, y = src_n[..., 0], src_n[..., 1]
+    u, v = dst_n[..., 0], dst_n[..., 1]
+    zeros = np.zeros_like(x)
+    ones = np.ones_like(x)
+    rows_u = np.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y], axis=2)
+    rows_v = np.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y], axis=2)
+    a = np.concatenate([rows_u, rows_v], axis=1)
+    b = np.concatenate([u, v], axis=1)
+    try:
+        h = np.linalg.solve(a, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        # degenerate point sets only spoil their own homography
+        h = np.stack([np.linalg.lstsq(a_k, b_k, rcond=None)[0] for a_k, b_k in zip(a, b)]) if len(a) else \
+            np.zeros((0, 8))
+    matrices = np.concatenate([h, np.ones((len(h), 1))], axis=1).reshape(-1, 3, 3)
+    matrices = np.linalg.inv(dst_t) @ matrices @ src_t
+    return matrices / matrices[:, 2:, 2:]
+
+
+def _normalization(points):
+    """
+    Similarity transforms moving the centroid of every point set to the origin and
+    its mean distance from the origin to sqrt(2)
+    """
+    center = points.mean(axis=1)
+    dist = np.linalg.norm(points - center[:, None], axis=2).mean(axis=1)
+    scale = np.sqrt(2) / np.maximum(dist, 1e-12)
+    t = np.zeros((len(points), 3, 3))
+    t[:, 0, 0] = scale
+    t[:, 1, 1] = scale
+    t[:, :2, 2] = -center * scale[:, None]
+    t[:, 2, 2] = 1
+    return t
+
+
+def _apply_similarity(t, points):
+    return points * t[:, None, [0, 1], [0, 1]] + t[:, None, :2, 2]
+
+
+def merge_lines(lines, max_dist=20):
+    """
+    Merge lines whose both ends are closer than max_dist into lines through the middle of the ends
+    :params
+        lines: array with shape (n,4) of x1,y1,x2,y2 lines
+        max_dist: maximum distance between ends of merged lines
+    :return
+        array with shape (m,4) of merged lines sorted by x1
+    """
+    def can_merge(line, others):
+        dist1 = np.hypot(others[:, 0] - line[0], others[:, 1] - line[1])
+        dist2 = np.hypot(others[:, 2] - line[2], others[:, 3] - line[3])
+        return (dist1 < max_dist) & (dist2 < max_dist)
+
+    def merge(line, other):
+        return ((line + other) / 2).astype(int)
+
+    return _merge_greedy(lines, 0, can_merge, merge)
+
+
+def merge_horizontal_lines(lines, max_dy=10):
+    """
+    Merge horizontal lines that belong to the same line on frame
+    :params
+        lines: array with shape (n,4) of x1,y1,x2,y2 lines
+        max_dy: maximum vertical distance between the right end of a line and the left end of the next
+    :return
+        array with shape (m,4) of merged lines sorted by x1
+    """
+    def can_merge(line, others):
+        return np.abs(others[:, 1] - line[3]) < max_dy
+
+    def merge(line, other):
+        return _outer_points(line, other, 0)
+
+    return _merge_greedy(lines, 0, can_merge, merge)
+
+
+def merge_vertical_lines(lines, height, width, max_dx=10):
+    """
+    Merge vertical lines that belong to the same line on frame, lines are compared
+    where they cross the horizontal line at 6/7 of the frame height
+    :params
+        lines: array with shape (n,4) of x1,y1,x2,y2 lines
+        height: frame height
+        width: frame width
+        max_dx: maximum horizontal distance between lines at 6/7 of the frame height
+    :return
+        array with shape (m,4) of merged lines sorted by y1
+    """
+    horizontal = np.array([0, height * 6 / 7, width, height * 6 / 7])
+
+    def can_merge(line, others):
+        xi = intersect_lines(line, horizontal)[0]
+        xj = intersect_lines(others, horizontal)[:, 0]
+        return np.abs(xi - xj) < max_dx
+
+    def merge(line, other):
+        return _outer_points(line, other, 1)
+
+    return _merge_greedy(lines, 1, can_merge, merge)
+
+
+def _outer_points(line, other, axis):
+    """
+    Line through the first and the last of the 4 end points of two lines along the axis
+    """
+    points = np.concatenate([line, other]).reshape(4, 2)
+    points = points[np.argsort(points[:, axis], kind='stable')]
+    return np.concatenate([points[0], points[-1]])
+
+
+def _merge_greedy(lines, key, can_merge, merge):
+    """
+    Sort lines by the coordinate key and merge every line with all following lines
+    it can be merged with, comparing them with the line merged so far
+    """
+    lines = np.asarray(lines).reshape(-1, 4)
+    lines = lines[np.argsort(lines[:, key], kind='stable')]
+    mask = np.ones(len(lines), dtype=bool)
+    new_lines = []
+    for i in range(len(lines)):
+        if not mask[i]:
+            continue
+        line = lines[i]
+        j = i + 1
+        while j < len(lines):
+            # the next following line that can be merged with the current line
+            candidates = np.flatnonzero(mask[j:] & can_merge(line, lines[j:]))
+            if len(candidates) == 0:
+                break
+            j += candidates[0]
+            line = merge(line, lines[j])
+            mask[j] = False
+            j += 1
+        new_lines.append(line)
+    return np.array(new_lines).reshape(-1, 4)
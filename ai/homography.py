@@ -1,7 +1,6 @@
 from .court_reference import CourtReference
+from .geometry import solve_homographies
 import numpy as np
-import cv2
-from scipy.spatial import distance
 
 court_ref = CourtReference()
 refer_kps = np.array(court_ref.key_points, dtype=np.float32).reshape((-1, 1, 2))
@@ -14,29 +13,61 @@ for i in range(len(court_ref.court_conf)):
         inds.append(court_ref.key_points.index(conf[j]))
     court_conf_ind[i+1] = inds
 
+# reference points of every configuration with shape (12,4,2) and indices of the keypoints they correspond to
+conf_points = np.array([court_ref.court_conf[i] for i in range(1, 13)], dtype=np.float64)
+conf_inds = np.array([court_conf_ind[i] for i in range(1, 13)])
+
+
 def get_trans_matrix(points):
     """
     Determine the best homography matrix from court points
     """
-    matrix_trans = None
-    dist_max = np.Inf
-    for conf_ind in range(1, 13):
-        conf = court_ref.court_conf[conf_ind]
-
-        inds = court_conf_ind[conf_ind]
-        inters = [points[inds[0]], points[inds[1]], points[inds[2]], points[inds[3]]]
-        if None not in inters:
-            matrix, _ = cv2.findHomography(np.float32(conf), np.float32(inters), method=0)
-            trans_kps = cv2.perspectiveTransform(refer_kps, matrix).squeeze(1)
-            dists = []
-            for i in range(12):
-                if i not in inds and points[i] is not None:
-                    dists.append(distance.euclidean(points[i], trans_kps[i]))
-            dist_median = np.mean(dists)
-            if dist_median < dist_max:
-                matrix_trans = matrix
-                dist_max = dist_median
-    return matrix_trans 
+    return get_trans_matrices([points])[0]
+
+
+def get_trans_matrices(points_batch):
+    """
+    Determine the best homography matrix from court points for a batch of frames. Homographies of all
+    court configurations of all frames are found with one batched linear solve and scored by the
+    mean reprojection error of the other keypoints, as cv2.findHomography followed by a Python loop did
+    :params
+        points_batch: list with 14 x,y court points or None per frame
+    :return
+        list of homography matrices from court reference to frame or None
+    """
+    num_frames = len(points_batch)
+    points = np.full((num_frames, 14, 2), np.nan)
+    for num, frame_points in enumerate(points_batch):
+        for i, point in enumerate(frame_points):
+            if point is not None:
+                points[num, i] = point
+    found = ~np.isnan(points[..., 0])
 
+    # (frame, configuration) pairs with all 4 points of the configuration found
+    usable = found[:, conf_inds].all(axis=2)
+    frame_ids, conf_ids = np.nonzero(usable)
+    matrices = solve_homographies(conf_points[conf_ids], points[frame_ids[:, None], conf_inds[conf_ids]])
 
+    # reprojection error of the first 12 keypoints that are not part of the configuration
+    refer = np.concatenate([refer_kps.reshape(-1, 2), np.ones((14, 1), dtype=np.float32)], axis=1)
+    projected = np.einsum('kij,nj->kni', matrices, refer.astype(np.float64))
+    projected = projected[..., :2] / projected[..., 2:]
+    dists = np.linalg.norm(projected - points[frame_ids], axis=2)
+    mask = found[frame_ids].copy()
+    mask[np.arange(len(conf_ids))[:, None], conf_inds[conf_ids]] = False
+    mask[:, 12:] = False
+    mask &= ~np.isnan(dists)
+    counts = mask.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        errors = np.where(mask, dists, 0).sum(axis=1) / counts
+    # configurations without other keypoints to check never win, nan compares as false in the loop
+    errors[counts == 0] = np.inf
 
+    result = [None] * num_frames
+    best = np.full(num_frames, np.inf)
+    # candidates are ordered by frame and then configuration, so strict comparison keeps the first minimum
+    for k, num in enumerate(frame_ids):
+        if errors[k] < best[num]:
+            best[num] = errors[k]
+            result[num] = matrices[k]
+    return result
@@ -0,0 +1,145 @@
+import os
+import torch
+
+
+def export_onnx(model, path_onnx, input_shape, device='cpu'):
+    """
+    Export model to ONNX with dynamic batch and spatial axes
+    :params
+        model: torch model in eval mode
+        path_onnx: path of the resulting .onnx file
+        input_shape: shape of a single input, e.g. (9, 360, 640)
+        device: device the model is placed on
+    """
+    dummy_input = torch.randn(1, *input_shape).float().to(device)
+    torch.onnx.export(
+        model,
+        dummy_input,
+        path_onnx,
+        input_names=["input"],
+        output_names=["output"],
+        dynamic_axes={"input": {0: "batch_size", 2: "height", 3: "width"},
+                      "output": {0: "batch_size", 2: "height", 3: "width"}},
+    )
+
+
+def get_onnx_path(path_model):
+    """
+    Exported models are cached next to the weights they were exported from
+    """
+    return os.path.splitext(path_model)[0] + '.onnx'
+
+
+def get_cached_export(model, path_model, input_shape):
+    """
+    Export model next to its weights unless an export newer than the weights already exists
+    :return
+        path_onnx: path of the exported model
+    """
+    path_onnx = get_onnx_path(path_model)
+    if not os.path.exists(path_onnx) or os.path.getmtime(path_onnx) < os.path.getmtime(path_model):
+        export_onnx(model.cpu(), path_onnx, input_shape)
+    return path_onnx
+
+
+def load_onnx_model(model, path_model, input_shape, num_threads=None):
+    """
+    Load the cached ONNX export of model, exporting it first if it is missing or older than the weights
+    :params
+        model: torch model with loaded weights in eval mode
+        path_model: path to pretrained weights of model
+        input_shape: shape of a single input, e.g. (9, 360, 640)
+        num_threads: number of threads ONNX Runtime may use, all cores by default
+    :return
+        OnnxModel
+    """
+    path_onnx = get_cached_export(model, path_model, input_shape)
+    return OnnxModel(path_onnx, num_threads)
+
+
+class OnnxModel:
+    """
+    Run an exported model with the CPU execution provider of ONNX Runtime.
+    It is called like the torch model it was exported from
+    """
+    def __init__(self, path_onnx, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # the graph is a single chain of convolutions, so parallelism inside operators is all that helps
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = num_threads or os.cpu_count()
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(path_onnx, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, inp):
+        """
+        :params
+            inp: input tensor with shape (batch, channels, height, width)
+        :return
+            output tensor on cpu
+        """
+        out = self.session.run(None, {'input': inp.detach().cpu().numpy()})[0]
+        return torch.from_numpy(out)
+
+
+def get_int8_path(path_model):
+    """
+    INT8 models are saved next to the weights they were quantized from
+    """
+    return os.path.splitext(path_model)[0] + '.int8.onnx'
+
+
+def quantize_onnx_model(model, path_model, input_shape, calibration_inputs):
+    """
+    Post-training static INT8 quantization of the ONNX export of model
+    :params
+        model: torch model with loaded weights in eval mode
+        path_model: path to pretrained weights of model
+        input_shape: shape of a single input, e.g. (9, 360, 640)
+        calibration_inputs: iterable of float32 arrays with shape (1, *input_shape),
+            a few hundred inputs from real footage are enough
+    :return
+        path_int8: path of the quantized model
+    """
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType,
+                                          quantize_static)
+
+    class InputReader(CalibrationDataReader):
+        def __init__(self, inputs):
+            self.inputs = iter(inputs)
+
+        def get_next(self):
+            inp = next(self.inputs, None)
+            return None if inp is None else {'input': inp}
+
+    path_onnx = get_cached_export(model, path_model, input_shape)
+    path_int8 = get_int8_path(path_model)
+    quantize_static(
+        path_onnx,
+        path_int8,
+        InputReader(calibration_inputs),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        # full resolution activations are large, so calibration statistics are reduced every few inputs
+        extra_options={'CalibMaxIntermediateOutputs': 16},
+    )
+    return path_int8
+
+
+def load_int8_model(path_model, num_threads=None):
+    """
+    Load the INT8 model produced by quantize_onnx_model for the given weights
+    :params
+        path_model: path to pretrained weights the model was quantized from
+        num_threads: number of threads ONNX Runtime may use, all cores by default
+    :return
+        OnnxModel
+    """
+    path_int8 = get_int8_path(path_model)
+    if not os.path.exists(path_int8):
+        raise FileNotFoundError('{} not found, calibrate it first with others/quantize.py'.format(path_int8))
+    return OnnxModel(path_int8, num_threads)
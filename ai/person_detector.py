@@ -8,56 +8,273 @@ from scipy.spatial import distance
 from tqdm import tqdm
 
 class PersonDetector():
-    def __init__(self, dtype=torch.FloatTensor):
+    def __init__(self, device='cpu', min_size=800, max_size=1333, roi_margin=None):
+        """
+        :params
+            device: torch device to run the model on
+            min_size: size of the smaller side of frames fed to Faster R-CNN, torchvision rescales every frame
+            max_size: maximum size of the larger side of frames fed to Faster R-CNN
+            roi_margin: if set, detect persons only in the bounding box of the court reference projected
+                to the frame, grown by this many pixels on every side. The crop is fed to the model
+                with the scale of the whole frame. The whole frame is used if None
+        """
         self.detection_model = torchvision.models.detection.fasterrcnn_resnet50_fpn(
-            weights=torchvision.models.detection.FasterRCNN_ResNet50_FPN_Weights.DEFAULT)
-        self.detection_model = self.detection_model.to(dtype)
+            weights=torchvision.models.detection.FasterRCNN_ResNet50_FPN_Weights.DEFAULT,
+            min_size=min_size, max_size=max_size)
+        self.detection_model = self.detection_model.to(device)
         self.detection_model.eval()
-        self.dtype = dtype
+        self.device = device
+        self.min_size = min_size
+        self.max_size = max_size
+        self.roi_margin = roi_margin
         self.court_ref = CourtReference()
-        self.ref_top_court = self.court_ref.get_court_mask(2)
-        self.ref_bottom_court = self.court_ref.get_court_mask(1)
         self.point_person_top = None
         self.point_person_bottom = None
         self.counter_top = 0
         self.counter_bottom = 0
 
         
-    def detect(self, image, person_min_score=0.85): 
+    def detect(self, image, person_min_score=0.85, roi=None): 
+        return self.detect_batch([image], person_min_score, roi)[0]
+
+    def detect_batch(self, images, person_min_score=0.85, roi=None):
+        """
+        Detect persons in several frames with one forward pass
+        :params
+            images: list of video frames of the same size
+            person_min_score: minimum score of detected persons
+            roi: (x_min, y_min, x_max, y_max) part of the frames to detect persons in or None for whole frames
+        :return
+            list of (persons_boxes, probs) pairs, one per frame, boxes are in frame coordinates
+        """
         PERSON_LABEL = 1
-        frame_tensor = image.transpose((2, 0, 1)) / 255
-        frame_tensor = torch.from_numpy(frame_tensor).unsqueeze(0).float().to(self.dtype)
-        
-        with torch.no_grad():
-            preds = self.detection_model(frame_tensor)
-            
-        persons_boxes = []
-        probs = []
-        for box, label, score in zip(preds[0]['boxes'][:], preds[0]['labels'], preds[0]['scores']):
-            if label == PERSON_LABEL and score > person_min_score:    
-                persons_boxes.append(box.detach().cpu().numpy())
-                probs.append(score.detach().cpu().numpy())
-        return persons_boxes, probs
+        x_min, y_min = 0, 0
+        if roi is not None:
+            # crops are resized by the scale torchvision resizes whole frames by
+            shape = images[0].shape[:2]
+            scale = min(self.min_size / min(shape), self.max_size / max(shape))
+            x_min, y_min, x_max, y_max = roi
+            images = [image[y_min:y_max, x_min:x_max] for image in images]
+            self.set_input_scale(scale, images[0].shape[:2])
+        frame_tensors = [torch.from_numpy(np.ascontiguousarray(image)).to(self.device).permute(2, 0, 1).float() / 255
+                         for image in images]
+
+        try:
+            with torch.inference_mode():
+                preds = self.detection_model(frame_tensors)
+        finally:
+            self.set_input_scale(None)
+
+        result = []
+        offset = torch.tensor([x_min, y_min, x_min, y_min], dtype=torch.float32)
+        for pred in preds:
+            keep = (pred['labels'] == PERSON_LABEL) & (pred['scores'] > person_min_score)
+            persons_boxes = list((pred['boxes'][keep].cpu() + offset).numpy())
+            probs = list(pred['scores'][keep].cpu().numpy())
+            result.append((persons_boxes, probs))
+        return result
+
+    def set_input_scale(self, scale, shape=None):
+        """
+        Make torchvision resize inputs of the given shape by scale instead of to min_size
+        :params
+            scale: resize factor or None to restore min_size and max_size
+            shape: (height, width) of the inputs
+        """
+        transform = self.detection_model.transform
+        if scale is None:
+            transform.min_size = (self.min_size,)
+            transform.max_size = self.max_size
+        else:
+            transform.min_size = (min(shape) * scale,)
+            transform.max_size = max(shape) * scale
+
+    def court_roi(self, inv_matrices, shape):
+        """
+        Bounding box of the court reference projected to frames, grown by roi_margin and clipped to the frame
+        :params
+            inv_matrices: list of homography matrices from frame to court reference
+            shape: (height, width) of the frames
+        :return
+            (x_min, y_min, x_max, y_max) box covering the court in all frames or None to use whole frames
+        """
+        height, width = shape
+        ref_height, ref_width = self.court_ref.court.shape
+        corners = np.float64([[0, 0, 1], [ref_width, 0, 1], [0, ref_height, 1], [ref_width, ref_height, 1]])
+        points = []
+        for inv_matrix in inv_matrices:
+            projected = corners @ cv2.invert(np.float64(inv_matrix))[1].T
+            # a corner behind the camera projects through infinity
+            if (projected[:, 2] <= 0).any():
+                return None
+            points.append(projected[:, :2] / projected[:, 2:])
+        points = np.concatenate(points)
+        x_min, y_min = np.floor(points.min(axis=0)) - self.roi_margin
+        x_max, y_max = np.ceil(points.max(axis=0)) + self.roi_margin
+        x_min, y_min = int(max(x_min, 0)), int(max(y_min, 0))
+        x_max, y_max = int(min(x_max, width)), int(min(y_max, height))
+        # torchvision needs inputs of at least a few pixels
+        if x_max - x_min < 32 or y_max - y_min < 32:
+            return None
+        return x_min, y_min, x_max, y_max
     
     def detect_top_and_bottom_players(self, image, inv_matrix, filter_players=False):
-        matrix = cv2.invert(inv_matrix)[1]
-        mask_top_court = cv2.warpPerspective(self.ref_top_court, matrix, image.shape[1::-1])
-        mask_bottom_court = cv2.warpPerspective(self.ref_bottom_court, matrix, image.shape[1::-1])
+        roi = self.court_roi([inv_matrix], image.shape[:2]) if self.roi_margin is not None else None
+        bboxes, probs = self.detect(image, person_min_score=0.85, roi=roi)
+        return self.split_top_and_bottom(inv_matrix, bboxes, filter_players)
+
+    def split_top_and_bottom(self, inv_matrix, bboxes, filter_players=False):
+        """
+        Split detected persons to the top and bottom half of the court by the point between their feet.
+        The points are projected to the court reference, where the halves are split by the net line
+        :params
+            inv_matrix: homography matrix from frame to court reference
+            bboxes: list of person boxes detected in the frame
+            filter_players: leave only one person at the top and the bottom
+        :return
+            person_bboxes_top, person_bboxes_bottom: lists of (bbox, feet point) pairs
+        """
         person_bboxes_top, person_bboxes_bottom = [], []
 
-        bboxes, probs = self.detect(image, person_min_score=0.85)
         if len(bboxes) > 0:
             person_points = [[int((bbox[2] + bbox[0]) / 2), int(bbox[3])] for bbox in bboxes]
             person_bboxes = list(zip(bboxes, person_points))
-  
-            person_bboxes_top = [pt for pt in person_bboxes if mask_top_court[pt[1][1]-1, pt[1][0]] == 1]
-            person_bboxes_bottom = [pt for pt in person_bboxes if mask_bottom_court[pt[1][1] - 1, pt[1][0]] == 1]
+            # the pixel above the feet point is classified, as it was looked up in the court masks
+            feet_points = np.float64([[x, y - 1] for x, y in person_points]).reshape((-1, 1, 2))
+            ref_points = cv2.perspectiveTransform(feet_points, np.float64(inv_matrix)).reshape(-1, 2)
+            is_top, is_bottom = self.court_halves(ref_points)
+
+            person_bboxes_top = [pt for pt, top in zip(person_bboxes, is_top) if top]
+            person_bboxes_bottom = [pt for pt, bottom in zip(person_bboxes, is_bottom) if bottom]
 
             if filter_players:
+                matrix = cv2.invert(inv_matrix)[1]
                 person_bboxes_top, person_bboxes_bottom = self.filter_players(person_bboxes_top, person_bboxes_bottom,
                                                                               matrix)
         return person_bboxes_top, person_bboxes_bottom
 
+    def court_halves(self, ref_points):
+        """
+        Check which points of the court reference are in its top and bottom half. The halves are the court
+        masks of CourtReference, points are rounded to their nearest reference pixel
+        :params
+            ref_points: array with shape (n,2) of x,y points in court reference coordinates
+        :return
+            is_top, is_bottom: boolean arrays with shape (n,)
+        """
+        height, width = self.court_ref.court.shape
+        net_y = self.court_ref.net[0][1]
+        x = np.floor(ref_points[:, 0] + 0.5)
+        y = np.floor(ref_points[:, 1] + 0.5)
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        return inside & (y < net_y), inside & (y >= net_y)
+
+    def infer_frames(self, frames, batch_size=1, filter_players=False):
+        """
+        Detect top and bottom players in a stream of frames, only the current batch is kept
+        :params
+            frames: iterable of (image, inv_matrix) pairs, video frame and homography matrix from frame
+                to court reference or None if the court was not found
+            batch_size: number of frames per forward pass
+            filter_players: leave only one person at the top and the bottom
+        :return
+            generator of (person_top, person_bottom) pairs, empty lists for frames without court
+        """
+        batch = []
+
+        def infer_batch():
+            # frames without court are not fed to the model
+            with_court = [(image, inv_matrix) for image, inv_matrix in batch if inv_matrix is not None]
+            roi = None
+            if with_court and self.roi_margin is not None:
+                # one crop for the whole batch, the court moves little between frames
+                roi = self.court_roi([inv_matrix for image, inv_matrix in with_court], with_court[0][0].shape[:2])
+            detections = iter(self.detect_batch([image for image, inv_matrix in with_court], roi=roi)
+                              if with_court else [])
+            for image, inv_matrix in batch:
+                if inv_matrix is None:
+                    yield [], []
+                else:
+                    bboxes, probs = next(detections)
+                    yield self.split_top_and_bottom(inv_matrix, bboxes, filter_players)
+
+        for image, inv_matrix in frames:
+            batch.append((image, inv_matrix))
+            if len(batch) == batch_size:
+                yield from infer_batch()
+                batch = []
+        if batch:
+            yield from infer_batch()
+
+    def track_frames(self, frames, interval=10, filter_players=False, min_tracked=0.5):
+        """
+        Detect persons every interval frames and move their boxes with optical flow in between.
+        Persons are detected again when the court appears, when interval frames passed since the last
+        detection or when the flow of a box can not be followed
+        :params
+            frames: iterable of (image, inv_matrix) pairs, video frame and homography matrix from frame
+                to court reference or None if the court was not found
+            interval: maximum number of frames between detections
+            filter_players: leave only one person at the top and the bottom
+            min_tracked: detect again when less than this share of the points of a box were tracked
+        :return
+            generator of (person_top, person_bottom) pairs, as returned by infer_frames
+        """
+        bboxes = None
+        prev_gray = None
+        num_tracked = 0
+        for image, inv_matrix in frames:
+            if inv_matrix is None:
+                bboxes = None
+                yield [], []
+                continue
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            if bboxes is not None and num_tracked < interval:
+                bboxes = self.track_boxes(prev_gray, gray, bboxes, min_tracked)
+            else:
+                bboxes = None
+            if bboxes is None:
+                roi = self.court_roi([inv_matrix], image.shape[:2]) if self.roi_margin is not None else None
+                bboxes, probs = self.detect(image, roi=roi)
+                num_tracked = 0
+            else:
+                num_tracked += 1
+            prev_gray = gray
+            # court halves are found with the homography of every frame
+            yield self.split_top_and_bottom(inv_matrix, bboxes, filter_players)
+
+    def track_boxes(self, prev_gray, gray, bboxes, min_tracked=0.5, grid_size=5):
+        """
+        Move boxes by the median optical flow of a grid of points inside them
+        :params
+            prev_gray: previous frame in grayscale
+            gray: current frame in grayscale
+            bboxes: list of x_min, y_min, x_max, y_max boxes on the previous frame
+            min_tracked: minimum share of points of every box that has to be tracked
+            grid_size: number of points along every side of the grid
+        :return
+            list of boxes on the current frame or None if a box was lost
+        """
+        if len(bboxes) == 0:
+            return []
+        boxes = np.float32(bboxes)
+        # the middle of the box, the corners are mostly background
+        steps = np.linspace(0.2, 0.8, grid_size, dtype=np.float32)
+        grid_x, grid_y = np.meshgrid(steps, steps)
+        xs = boxes[:, None, 0] + grid_x.ravel() * (boxes[:, None, 2] - boxes[:, None, 0])
+        ys = boxes[:, None, 1] + grid_y.ravel() * (boxes[:, None, 3] - boxes[:, None, 1])
+        points = np.stack([xs, ys], axis=2).reshape(-1, 1, 2)
+        new_points, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points, None)
+        # points that do not flow back to where they started were not tracked
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, new_points, None)
+        error = np.linalg.norm(back_points - points, axis=2).ravel()
+        tracked = ((status.ravel() == 1) & (back_status.ravel() == 1) & (error < 1)).reshape(len(boxes), -1)
+        if (tracked.mean(axis=1) < min_tracked).any():
+            return None
+        flow = (new_points - points).reshape(len(boxes), -1, 2)
+        shifts = [np.median(box_flow[box_tracked], axis=0) for box_flow, box_tracked in zip(flow, tracked)]
+        return [box + np.tile(shift, 2) for box, shift in zip(boxes, shifts)]
+
     def filter_players(self, person_bboxes_top, person_bboxes_bottom, matrix):
         """
         Leave one person at the top and bottom of the tennis court
@@ -76,18 +293,15 @@ class PersonDetector():
             person_bboxes_bottom = [person_bboxes_bottom[ind]]
         return person_bboxes_top, person_bboxes_bottom
     
-    def track_players(self, frames, matrix_all, filter_players=False):
+    def track_players(self, frames, matrix_all, filter_players=False, batch_size=1, interval=None):
         persons_top = []
         persons_bottom = []
-        min_len = min(len(frames), len(matrix_all))
         print("track players processing")
-        for num_frame in tqdm(range(min_len)):
-            img = frames[num_frame]
-            if matrix_all[num_frame] is not None:
-                inv_matrix = matrix_all[num_frame]
-                person_top, person_bottom = self.detect_top_and_bottom_players(img, inv_matrix, filter_players)
-            else:
-                person_top, person_bottom = [], []
+        if interval:
+            persons = self.track_frames(zip(frames, matrix_all), interval, filter_players)
+        else:
+            persons = self.infer_frames(zip(frames, matrix_all), batch_size, filter_players)
+        for person_top, person_bottom in tqdm(persons):
             persons_top.append(person_top)
             persons_bottom.append(person_bottom)
         return persons_top, persons_bottom    
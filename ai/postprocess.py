@@ -1,27 +1,22 @@
 import cv2
 import numpy as np
-from sympy import Line
-from scipy.spatial import distance
-from sympy.geometry.point import Point2D
+from .geometry import intersect_lines, merge_lines
 
 
 def line_intersection(line1, line2):
     """
     Find 2 lines intersection point
+    :params
+        line1, line2: x1,y1,x2,y2 points of the lines
+    :return
+        x,y intersection point or None for parallel lines
     """
-    l1 = Line((line1[0], line1[1]), (line1[2], line1[3]))
-    l2 = Line((line2[0], line2[1]), (line2[2], line2[3]))
-
-    intersection = l1.intersection(l2)
-    point = None
-    if len(intersection) > 0:
-        if isinstance(intersection[0], Point2D):
-            point = intersection[0].coordinates
-    return point 
+    point = intersect_lines(line1, line2)
+    if np.isnan(point[0]):
+        return None
+    return point[0], point[1]
 
 def refine_kps(img, x_ct, y_ct, crop_size=40):
-    refined_x_ct, refined_y_ct = x_ct, y_ct
-    
     img_height, img_width = img.shape[:2]
     x_min = max(x_ct-crop_size, 0)
     x_max = min(img_height, x_ct+crop_size)
@@ -29,7 +24,21 @@ def refine_kps(img, x_ct, y_ct, crop_size=40):
     y_max = min(img_width, y_ct+crop_size)
 
     img_crop = img[x_min:x_max, y_min:y_max]
-    lines = detect_lines(img_crop)
+    return refine_in_crop(threshold_lines(img_crop), x_ct, y_ct, x_min, y_min)
+
+def refine_in_crop(binary_crop, x_ct, y_ct, x_min, y_min):
+    """
+    Move a keypoint to the intersection of the two court lines in the crop around it
+    :params
+        binary_crop: thresholded crop around the keypoint
+        x_ct, y_ct: row and column of the keypoint in the frame
+        x_min, y_min: row and column of the top left corner of the crop in the frame
+    :return
+        column and row of the refined keypoint, the keypoint itself if the crop does not show
+        exactly two lines crossing inside it
+    """
+    refined_x_ct, refined_y_ct = x_ct, y_ct
+    lines = find_lines(binary_crop)
     # print('lines = ', lines)
     
     if len(lines) > 1:
@@ -39,14 +48,70 @@ def refine_kps(img, x_ct, y_ct, crop_size=40):
             if inters:
                 new_x_ct = int(inters[1])
                 new_y_ct = int(inters[0])
-                if new_x_ct > 0 and new_x_ct < img_crop.shape[0] and new_y_ct > 0 and new_y_ct < img_crop.shape[1]:
+                if new_x_ct > 0 and new_x_ct < binary_crop.shape[0] and new_y_ct > 0 and new_y_ct < binary_crop.shape[1]:
                     refined_x_ct = x_min + new_x_ct
                     refined_y_ct = y_min + new_y_ct                    
     return refined_y_ct, refined_x_ct
 
-def detect_lines(image):
+def refine_kps_batch(images, points, crop_size=40):
+    """
+    Refine keypoints of a batch of frames. Every frame is converted to gray and thresholded once,
+    in the bounding box of all its crops, and only Hough lines are found crop by crop
+    :params
+        images: list of original video frames
+        points: list with a list of x,y keypoints per frame, None for keypoints that are not refined
+        crop_size: half size of the crop around every keypoint
+    :return
+        refined: list with a list of refined x,y keypoints per frame, None where points are None.
+            Keypoints are truncated to integer pixels as in refine_kps
+        stats: dict with the number of refined keypoints and the number of them that moved
+    """
+    refined = []
+    stats = {'refined': 0, 'moved': 0}
+    for img, frame_points in zip(images, points):
+        img_height, img_width = img.shape[:2]
+        # rows and columns of the keypoints and their crops, as in refine_kps
+        centers = []
+        boxes = []
+        for p in frame_points:
+            if p is None:
+                centers.append(None)
+                boxes.append(None)
+                continue
+            x_ct, y_ct = int(p[1]), int(p[0])
+            centers.append((x_ct, y_ct))
+            boxes.append((max(x_ct-crop_size, 0), min(img_height, x_ct+crop_size),
+                          max(y_ct-crop_size, 0), min(img_width, y_ct+crop_size)))
+        valid = [box for box in boxes if box is not None]
+        if not valid:
+            refined.append([None] * len(frame_points))
+            continue
+        # thresholding is pointwise, so thresholding the region once gives the same crops
+        top = min(box[0] for box in valid)
+        bottom = max(box[1] for box in valid)
+        left = min(box[2] for box in valid)
+        right = max(box[3] for box in valid)
+        binary = threshold_lines(img[top:bottom, left:right])
+
+        frame_refined = []
+        for center, box in zip(centers, boxes):
+            if center is None:
+                frame_refined.append(None)
+                continue
+            x_min, x_max, y_min, y_max = box
+            binary_crop = binary[x_min - top:x_max - top, y_min - left:y_max - left]
+            point = refine_in_crop(binary_crop, center[0], center[1], x_min, y_min)
+            stats['refined'] += 1
+            stats['moved'] += point != (center[1], center[0])
+            frame_refined.append(point)
+        refined.append(frame_refined)
+    return refined, stats
+
+def threshold_lines(image):
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    gray = cv2.threshold(gray, 155, 255, cv2.THRESH_BINARY)[1]
+    return cv2.threshold(gray, 155, 255, cv2.THRESH_BINARY)[1]
+
+def find_lines(gray):
     lines = cv2.HoughLinesP(gray, 1, np.pi / 180, 30, minLineLength=10, maxLineGap=30)
     lines = np.squeeze(lines) 
     if len(lines.shape) > 0:
@@ -56,22 +121,5 @@ def detect_lines(image):
         lines = []
     return lines
 
-def merge_lines(lines):
-    lines = sorted(lines, key=lambda item: item[0])
-    mask = [True] * len(lines)
-    new_lines = []
-
-    for i, line in enumerate(lines):
-        if mask[i]:
-            for j, s_line in enumerate(lines[i + 1:]):
-                if mask[i + j + 1]:
-                    x1, y1, x2, y2 = line
-                    x3, y3, x4, y4 = s_line
-                    dist1 = distance.euclidean((x1, y1), (x3, y3))
-                    dist2 = distance.euclidean((x2, y2), (x4, y4))
-                    if dist1 < 20 and dist2 < 20:
-                        line = np.array([int((x1+x3)/2), int((y1+y3)/2), int((x2+x4)/2), int((y2+y4)/2)])
-                        mask[i + j + 1] = False
-            new_lines.append(line)  
-    return new_lines       
-
+def detect_lines(image):
+    return find_lines(threshold_lines(image))
@@ -1,6 +1,28 @@
 import torch.nn as nn
 import torch
 
+def tiled_argmax(block, x, tile_rows):
+    """
+    Evaluate the last 3x3 block of the network and the argmax over its channels in horizontal
+    tiles, so the full resolution output of the block is never materialized
+    :params
+        block: last block of the network with 3x3 convolution and padding 1
+        x: input of the block with shape (batch,channels,height,width)
+        tile_rows: number of output rows computed at once
+    :return
+        argmax over channels with shape (batch,height,width)
+    """
+    height = x.shape[2]
+    out = torch.empty((x.shape[0], height, x.shape[3]), dtype=torch.long, device=x.device)
+    for start in range(0, height, tile_rows):
+        end = min(start + tile_rows, height)
+        # one halo row on each side inside the image, the padding of the block covers the image border;
+        # output rows computed from a halo row are dropped
+        lo, hi = max(start - 1, 0), min(end + 1, height)
+        tile = block(x[:, :, lo:hi])
+        out[:, start:end] = tile[:, :, start - lo:end - lo].argmax(dim=1)
+    return out
+
 class ConvBlock(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=3, pad=1, stride=1, bias=True):
         super().__init__()
@@ -73,6 +95,21 @@ class BallTrackerNet(nn.Module):
         x = self.conv18(x)
         return x
     
+    def forward_argmax(self, x, tile_rows=None):
+        """
+        :params
+            x: input tensor with shape (batch,channels,height,width)
+            tile_rows: evaluate the last block and the argmax in tiles of this many rows to save memory
+        :return
+            argmax over output channels with shape (batch,height,width)
+        """
+        layers = list(self.children())
+        for layer in layers[:-1]:
+            x = layer(x)
+        if tile_rows is None:
+            return layers[-1](x).argmax(dim=1)
+        return tiled_argmax(layers[-1], x, tile_rows)
+
     def _init_weights(self):
         for module in self.modules():
             if isinstance(module, nn.Conv2d):
@@ -84,5 +121,118 @@ class BallTrackerNet(nn.Module):
                 nn.init.constant_(module.weight, 1)
                 nn.init.constant_(module.bias, 0)   
 
-    
-    
\ No newline at end of file
+class FusedConvBlock(nn.Module):
+    """
+    ConvBlock with its BatchNorm folded away, built by fuse_tracknet.
+    The BatchNorm scale is folded into the convolution through ReLU(a*z) = a*ReLU(z) for a >= 0
+    and applied explicitly otherwise. The BatchNorm shift of the previous block is folded into
+    the bias of this convolution, border stores what zero padding took away from it on the
+    edge rows and columns
+    """
+    def __init__(self, conv, border=None, scale=None, shift=None):
+        super().__init__()
+        self.conv = conv
+        self.has_border = border is not None
+        self.has_scale = scale is not None
+        self.has_shift = shift is not None
+        out_channels = conv.out_channels
+        self.register_buffer('border', border if border is not None else torch.zeros(8, out_channels))
+        scale = scale if scale is not None else torch.ones(out_channels)
+        shift = shift if shift is not None else torch.zeros(out_channels)
+        self.register_buffer('scale', scale.view(1, -1, 1, 1))
+        self.register_buffer('shift', shift.view(1, -1, 1, 1))
+
+    def forward(self, x):
+        x = self.conv(x)
+        if self.has_border:
+            # top, bottom, left and right edges, then corners covered by two edges
+            x[:, :, 0] += self.border[0].view(1, -1, 1)
+            x[:, :, -1] += self.border[1].view(1, -1, 1)
+            x[:, :, :, 0] += self.border[2].view(1, -1, 1)
+            x[:, :, :, -1] += self.border[3].view(1, -1, 1)
+            x[:, :, 0, 0] += self.border[4]
+            x[:, :, 0, -1] += self.border[5]
+            x[:, :, -1, 0] += self.border[6]
+            x[:, :, -1, -1] += self.border[7]
+        x = torch.relu_(x)
+        if self.has_scale:
+            x = x.mul_(self.scale)
+        if self.has_shift:
+            x = x.add_(self.shift)
+        return x
+
+class FusedTrackNet(nn.Module):
+    def __init__(self, layers):
+        super().__init__()
+        self.layers = nn.Sequential(*layers)
+
+    def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
+        return self.layers(x)
+
+    def forward_argmax(self, x, tile_rows=None):
+        """
+        :params
+            x: input tensor with shape (batch,channels,height,width)
+            tile_rows: evaluate the last block and the argmax in tiles of this many rows to save memory
+        :return
+            argmax over output channels with shape (batch,height,width)
+        """
+        x = x.contiguous(memory_format=torch.channels_last)
+        x = self.layers[:-1](x)
+        if tile_rows is None:
+            return self.layers[-1](x).argmax(dim=1)
+        return tiled_argmax(self.layers[-1], x, tile_rows)
+
+@torch.no_grad()
+def fuse_tracknet(model):
+    """
+    Build an inference-only copy of BallTrackerNet without BatchNorm layers.
+    Outputs match the original model in eval mode up to float rounding
+    :params
+        model: BallTrackerNet with loaded weights
+    :return
+        FusedTrackNet in eval mode with channels last weights, it can be scripted with
+        torch.jit.script or compiled with torch.compile
+    """
+    layers = []
+    # per-channel constant the output of the last block still lacks
+    shift = None
+    for module in model.children():
+        if not isinstance(module, ConvBlock):
+            # max pooling and nearest upsampling commute with adding a per-channel constant
+            layers.append(module)
+            continue
+        conv, bn = module.block[0], module.block[2]
+        assert conv.kernel_size == (3, 3) and conv.padding == (1, 1) and conv.stride == (1, 1)
+        fused = nn.Conv2d(conv.in_channels, conv.out_channels, 3, padding=1).to(conv.weight.device)
+        weight = conv.weight.clone()
+        bias = conv.bias.clone() if conv.bias is not None else torch.zeros_like(bn.running_mean)
+
+        border = None
+        if shift is not None:
+            # contribution of the shift through every kernel tap
+            taps = (weight * shift.view(1, -1, 1, 1)).sum(1)
+            bias += taps.sum((1, 2))
+            border = torch.stack([
+                -taps[:, 0].sum(1), -taps[:, 2].sum(1), -taps[:, :, 0].sum(1), -taps[:, :, 2].sum(1),
+                taps[:, 0, 0], taps[:, 0, 2], taps[:, 2, 0], taps[:, 2, 2]])
+
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+        if (scale >= 0).all():
+            weight *= scale.view(-1, 1, 1, 1)
+            bias *= scale
+            if border is not None:
+                border *= scale
+            scale = None
+
+        fused.weight.copy_(weight)
+        fused.bias.copy_(bias)
+        layers.append(FusedConvBlock(fused, border, scale))
+
+    # nothing follows the last block, so its shift is added explicitly
+    last = layers[-1]
+    last.shift.copy_(shift.view(1, -1, 1, 1))
+    last.has_shift = True
+    return FusedTrackNet(layers).to(memory_format=torch.channels_last).eval()
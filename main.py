@@ -5,22 +5,91 @@ from ai.court_reference import CourtReference
 from ai.bounce_detector import BounceDetector
 from ai.ball_detector import BallDetector
 from ai.person_detector import PersonDetector
-from utils import scene_detect
+from utils import SceneDetector
+from utils2.video_utils import iter_video, get_video_fps, get_video_size
+from collections import deque
+import itertools
 import argparse
 import torch
+from tqdm import tqdm
 
-def read_video(path_video):
-    cap = cv2.VideoCapture(path_video)
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
-    frames = []
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if ret:
-            frames.append(frame)
-        else:
-            break    
-    cap.release()
-    return frames, fps
+def analyze_video(path_video, ball_detector, court_detector, person_detector, batch_size=1, court_interval=None,
+                  person_batch_size=1, person_interval=None):
+    """
+    Run scene, ball, court and person detection in a single streaming pass over the video
+    :params
+        path_video: path to input video
+        ball_detector: BallDetector instance
+        court_detector: CourtDetectorNet instance
+        person_detector: PersonDetector instance
+        batch_size: number of frames per forward pass of the ball and court networks
+        court_interval: detect the court only on the first frame of every scene, every court_interval
+            frames and when the court lines drift, reusing the homography in between.
+            None detects the court on every frame
+        person_batch_size: number of frames per forward pass of the person detector
+        person_interval: detect persons every person_interval frames and follow them with optical flow
+            in between. None detects persons on every frame
+    :return
+        scenes: list of beginning and ending of video fragment
+        ball_track: list of (x,y) ball coordinates
+        homography_matrices: list of homography matrices
+        kps_court: list of 14 key points of tennis court
+        persons_top: list of person bboxes located in the top of tennis court
+        persons_bottom: list of person bboxes located in the bottom of tennis court
+    """
+    ball_track = []
+    homography_matrices = []
+    kps_court = []
+    persons_top = []
+    persons_bottom = []
+    # frames are downscaled once for the networks and the scene detector;
+    # all copies are consumed in lockstep, so tee keeps at most one batch of frames
+    # and the ball detector keeps its own 3-frame window
+    width, height = get_video_size(path_video)
+    scene_detector = SceneDetector()
+
+    def decode():
+        # scene cuts are found as frames are decoded, so the court detector can use them. A cut can be
+        # reported a few frames late, frames are held back that long to flag the first frame of the scene
+        pending = deque()
+        for num, frame in enumerate(iter_video(path_video)):
+            img = cv2.resize(frame, (ball_detector.width, ball_detector.height))
+            pending.append([frame, img, False])
+            for cut in scene_detector.process_frame(img):
+                # pending holds the frames num - len(pending) + 1 .. num
+                index = cut - (num - len(pending) + 1)
+                if 0 <= index < len(pending):
+                    pending[index][2] = True
+            if len(pending) > scene_detector.max_delay:
+                yield tuple(pending.popleft())
+        while pending:
+            yield tuple(pending.popleft())
+
+    frames, frames_ball, frames_court, frames_person = itertools.tee(decode(), 4)
+    frames_ball = (img for frame, img, new_scene in frames_ball)
+    scale = (width / ball_detector.width, height / ball_detector.height)
+    print('ball, court and person detection')
+    ball_points = ball_detector.infer_frames(frames_ball, scale, batch_size)
+    if court_interval:
+        courts = court_detector.infer_keyframes(frames_court, court_interval)
+    else:
+        courts = court_detector.infer_frames(((frame, img) for frame, img, new_scene in frames_court), batch_size)
+    # the person detector needs the homography of every frame, so it reads its own copy of the court results
+    courts, courts_person = itertools.tee(courts)
+    frames_person = ((frame, matrix) for (frame, img, new_scene), (matrix, kps) in zip(frames_person, courts_person))
+    if person_interval:
+        persons = person_detector.track_frames(frames_person, person_interval)
+    else:
+        persons = person_detector.infer_frames(frames_person, person_batch_size)
+    for (frame, img, new_scene), ball_point, (matrix, kps), (person_top, person_bottom) in zip(
+            frames, tqdm(ball_points), courts, persons):
+        ball_track.append(ball_point)
+        homography_matrices.append(matrix)
+        kps_court.append(kps)
+        persons_top.append(person_top)
+        persons_bottom.append(person_bottom)
+    scenes = scene_detector.get_scenes()
+    return scenes, ball_track, homography_matrices, kps_court, persons_top, persons_bottom
 
 def get_court_img():
     court_reference = CourtReference()
@@ -33,7 +102,7 @@ def main(frames, scenes, bounces, ball_track, homography_matrices, kps_court, pe
          draw_trace=False, trace=7):
     """
     :params
-        frames: list of original images
+        frames: iterable of original images
         scenes: list of beginning and ending of video fragment
         bounces: list of image numbers where ball touches the ground
         ball_track: list of (x,y) ball coordinates
@@ -44,93 +113,99 @@ def main(frames, scenes, bounces, ball_track, homography_matrices, kps_court, pe
         draw_trace: whether to draw ball trace
         trace: the length of ball trace
     :return
-        imgs_res: list of resulting images
+        generator of resulting images
     """
-    imgs_res = []
     width_minimap = 166
     height_minimap = 350
     is_track = [x is not None for x in homography_matrices] 
-    for num_scene in range(len(scenes)):
-        sum_track = sum(is_track[scenes[num_scene][0]:scenes[num_scene][1]])
-        len_track = scenes[num_scene][1] - scenes[num_scene][0]
+    num_scene = -1
+    for i, img_res in enumerate(frames):
+        if num_scene == -1 or i >= scenes[num_scene][1]:
+            num_scene += 1
+            while num_scene < len(scenes) and i >= scenes[num_scene][1]:
+                num_scene += 1
+            if num_scene == len(scenes):
+                break
+            sum_track = sum(is_track[scenes[num_scene][0]:scenes[num_scene][1]])
+            len_track = scenes[num_scene][1] - scenes[num_scene][0]
 
-        eps = 1e-15
-        scene_rate = sum_track/(len_track+eps)
-        if (scene_rate > 0.5):
+            eps = 1e-15
+            scene_rate = sum_track/(len_track+eps)
             court_img = get_court_img()
+        if i < scenes[num_scene][0]:
+            continue
+        if (scene_rate <= 0.5):
+            yield img_res
+            continue
+
+        inv_mat = homography_matrices[i]
+
+        # draw ball trajectory
+        if ball_track[i][0]:
+            if draw_trace:
+                for j in range(0, trace):
+                    if i-j >= 0:
+                        if ball_track[i-j][0]:
+                            draw_x = int(ball_track[i-j][0])
+                            draw_y = int(ball_track[i-j][1])
+                            img_res = cv2.circle(img_res, (draw_x, draw_y),
+                            radius=3, color=(0, 255, 0), thickness=2)
+            else:    
+                img_res = cv2.circle(img_res , (int(ball_track[i][0]), int(ball_track[i][1])), radius=5,
+                                     color=(0, 255, 0), thickness=2)
+                img_res = cv2.putText(img_res, 'ball', 
+                      org=(int(ball_track[i][0]) + 8, int(ball_track[i][1]) + 8),
+                      fontFace=cv2.FONT_HERSHEY_SIMPLEX,
+                      fontScale=0.8,
+                      thickness=2,
+                      color=(0, 255, 0))
+
+        # draw court keypoints
+        if kps_court[i] is not None:
+            for j in range(len(kps_court[i])):
+                img_res = cv2.circle(img_res, (int(kps_court[i][j][0, 0]), int(kps_court[i][j][0, 1])),
+                                  radius=0, color=(0, 0, 255), thickness=10)
+
+        height, width, _ = img_res.shape
+
+        # draw bounce in minimap
+        if i in bounces and inv_mat is not None:
+            ball_point = ball_track[i]
+            ball_point = np.array(ball_point, dtype=np.float32).reshape(1, 1, 2)
+            ball_point = cv2.perspectiveTransform(ball_point, inv_mat)
+            court_img = cv2.circle(court_img, (int(ball_point[0, 0, 0]), int(ball_point[0, 0, 1])),
+                                               radius=0, color=(0, 255, 255), thickness=50)
+
+        minimap = court_img.copy()
+
+        # draw persons
+        persons = persons_top[i] + persons_bottom[i]                    
+        for j, person in enumerate(persons):
+            if len(person[0]) > 0:
+                person_bbox = list(person[0])
+                img_res = cv2.rectangle(img_res, (int(person_bbox[0]), int(person_bbox[1])),
+                                        (int(person_bbox[2]), int(person_bbox[3])), [255, 0, 0], 2)
+
+                # transmit person point to minimap
+                person_point = list(person[1])
+                person_point = np.array(person_point, dtype=np.float32).reshape(1, 1, 2)
+                person_point = cv2.perspectiveTransform(person_point, inv_mat)
+                minimap = cv2.circle(minimap, (int(person_point[0, 0, 0]), int(person_point[0, 0, 1])),
+                                                   radius=0, color=(255, 0, 0), thickness=80)
+
+        minimap = cv2.resize(minimap, (width_minimap, height_minimap))
+        img_res[30:(30 + height_minimap), (width - 30 - width_minimap):(width - 30), :] = minimap
+        yield img_res
 
-            for i in range(scenes[num_scene][0], scenes[num_scene][1]):
-                img_res = frames[i]
-                inv_mat = homography_matrices[i]
-
-                # draw ball trajectory
-                if ball_track[i][0]:
-                    if draw_trace:
-                        for j in range(0, trace):
-                            if i-j >= 0:
-                                if ball_track[i-j][0]:
-                                    draw_x = int(ball_track[i-j][0])
-                                    draw_y = int(ball_track[i-j][1])
-                                    img_res = cv2.circle(frames[i], (draw_x, draw_y),
-                                    radius=3, color=(0, 255, 0), thickness=2)
-                    else:    
-                        img_res = cv2.circle(img_res , (int(ball_track[i][0]), int(ball_track[i][1])), radius=5,
-                                             color=(0, 255, 0), thickness=2)
-                        img_res = cv2.putText(img_res, 'ball', 
-                              org=(int(ball_track[i][0]) + 8, int(ball_track[i][1]) + 8),
-                              fontFace=cv2.FONT_HERSHEY_SIMPLEX,
-                              fontScale=0.8,
-                              thickness=2,
-                              color=(0, 255, 0))
-
-                # draw court keypoints
-                if kps_court[i] is not None:
-                    for j in range(len(kps_court[i])):
-                        img_res = cv2.circle(img_res, (int(kps_court[i][j][0, 0]), int(kps_court[i][j][0, 1])),
-                                          radius=0, color=(0, 0, 255), thickness=10)
-
-                height, width, _ = img_res.shape
-
-                # draw bounce in minimap
-                if i in bounces and inv_mat is not None:
-                    ball_point = ball_track[i]
-                    ball_point = np.array(ball_point, dtype=np.float32).reshape(1, 1, 2)
-                    ball_point = cv2.perspectiveTransform(ball_point, inv_mat)
-                    court_img = cv2.circle(court_img, (int(ball_point[0, 0, 0]), int(ball_point[0, 0, 1])),
-                                                       radius=0, color=(0, 255, 255), thickness=50)
-
-                minimap = court_img.copy()
-
-                # draw persons
-                persons = persons_top[i] + persons_bottom[i]                    
-                for j, person in enumerate(persons):
-                    if len(person[0]) > 0:
-                        person_bbox = list(person[0])
-                        img_res = cv2.rectangle(img_res, (int(person_bbox[0]), int(person_bbox[1])),
-                                                (int(person_bbox[2]), int(person_bbox[3])), [255, 0, 0], 2)
-
-                        # transmit person point to minimap
-                        person_point = list(person[1])
-                        person_point = np.array(person_point, dtype=np.float32).reshape(1, 1, 2)
-                        person_point = cv2.perspectiveTransform(person_point, inv_mat)
-                        minimap = cv2.circle(minimap, (int(person_point[0, 0, 0]), int(person_point[0, 0, 1])),
-                                                           radius=0, color=(255, 0, 0), thickness=80)
-
-                minimap = cv2.resize(minimap, (width_minimap, height_minimap))
-                img_res[30:(30 + height_minimap), (width - 30 - width_minimap):(width - 30), :] = minimap
-                imgs_res.append(img_res)
-
-        else:    
-            imgs_res = imgs_res + frames[scenes[num_scene][0]:scenes[num_scene][1]] 
-    return imgs_res        
- 
 def write(imgs_res, fps, path_output_video):
-    height, width = imgs_res[0].shape[:2]
-    out = cv2.VideoWriter(path_output_video, cv2.VideoWriter_fourcc(*'DIVX'), fps, (width, height))
-    for num in range(len(imgs_res)):
-        frame = imgs_res[num]
+    out = None
+    for frame in imgs_res:
+        if out is None:
+            height, width = frame.shape[:2]
+            out = cv2.VideoWriter(path_output_video, cv2.VideoWriter_fourcc(*'DIVX'), fps, (width, height))
         out.write(frame)
-    out.release()    
+    if out is not None:
+        out.release()    
 
 
 if __name__ == '__main__':
@@ -141,23 +216,59 @@ if __name__ == '__main__':
     parser.add_argument('--path_bounce_model', type=str, help='path to pretrained model for bounce detection')
     parser.add_argument('--path_input_video', type=str, help='path to input video')
     parser.add_argument('--path_output_video', type=str, help='path to output video')
+    parser.add_argument('--batch_size', type=int, default=1, help='number of frames per forward pass')
+    parser.add_argument('--tile_rows', type=int,
+                        help='evaluate the last block of the ball network in tiles of this many rows to cap its '
+                             'memory, torch and fused backends only')
+    parser.add_argument('--ball_decoder', type=str, default='blob', choices=['blob', 'hough'],
+                        help='find the ball with HoughCircles on crops of a whole batch of masks or on every '
+                             'whole mask, both give the same positions')
+    parser.add_argument('--court_sharp_peak', type=float,
+                        help='do not refine court keypoints whose heatmap maximum is at least this value')
+    parser.add_argument('--court_interval', type=int,
+                        help='detect the court on scene starts and every court_interval frames, '
+                             'reuse the homography in between')
+    parser.add_argument('--ball_roi', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+                        help='run the ball network on a crop of this size around the tracked ball')
+    parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'fused', 'onnx', 'onnx-int8'],
+                        help='run ball and court networks with PyTorch, with BatchNorm fused into convolutions '
+                             'or with ONNX Runtime on CPU')
+    parser.add_argument('--num_threads', type=int,
+                        help='number of CPU threads for the networks, all cores for ONNX Runtime '
+                             'and the torch default for PyTorch by default')
+    parser.add_argument('--person_batch_size', type=int, default=1,
+                        help='number of frames per forward pass of the person detector')
+    parser.add_argument('--person_min_size', type=int, default=800,
+                        help='size of the smaller frame side the person detector rescales frames to')
+    parser.add_argument('--person_max_size', type=int, default=1333,
+                        help='maximum size of the larger frame side the person detector rescales frames to')
+    parser.add_argument('--person_interval', type=int,
+                        help='detect persons every person_interval frames and follow them with optical flow '
+                             'in between')
+    parser.add_argument('--person_roi_margin', type=int,
+                        help='detect persons only in the bounding box of the projected court grown by this many '
+                             'pixels, whole frames if not set')
     args = parser.parse_args()
     
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    frames, fps = read_video(args.path_input_video) 
-    scenes = scene_detect(args.path_input_video)    
+    if args.num_threads:
+        # process-wide, applies to the person detector and the torch backends of ball and court networks
+        torch.set_num_threads(args.num_threads)
+    fps = get_video_fps(args.path_input_video)
 
-    print('ball detection')
-    ball_detector = BallDetector(args.path_ball_track_model, device)
-    ball_track = ball_detector.infer_model(frames)
-
-    print('court detection')
-    court_detector = CourtDetectorNet(args.path_court_model, device)
-    homography_matrices, kps_court = court_detector.infer_model(frames)
-
-    print('person detection')
-    person_detector = PersonDetector(device)
-    persons_top, persons_bottom = person_detector.track_players(frames, homography_matrices, filter_players=False)
+    ball_detector = BallDetector(args.path_ball_track_model, device, backend=args.backend,
+                                 decoder=args.ball_decoder, num_threads=args.num_threads, roi_size=args.ball_roi,
+                                 tile_rows=args.tile_rows)
+    court_detector = CourtDetectorNet(args.path_court_model, device, backend=args.backend, num_threads=args.num_threads,
+                                      sharp_peak=args.court_sharp_peak)
+    person_detector = PersonDetector(device, min_size=args.person_min_size, max_size=args.person_max_size,
+                                     roi_margin=args.person_roi_margin)
+    scenes, ball_track, homography_matrices, kps_court, persons_top, persons_bottom = analyze_video(
+        args.path_input_video, ball_detector, court_detector, person_detector, args.batch_size,
+        args.court_interval, args.person_batch_size, args.person_interval)
+    stats = court_detector.refine_stats
+    print('court keypoints refined: {}, moved by refinement: {}, skipped as sharp: {}'.format(
+        stats['refined'], stats['moved'], stats['skipped']))
 
     # bounce detection
     bounce_detector = BounceDetector(args.path_bounce_model)
@@ -165,12 +276,8 @@ if __name__ == '__main__':
     y_ball = [x[1] for x in ball_track]
     bounces = bounce_detector.predict(x_ball, y_ball)
 
-    imgs_res = main(frames, scenes, bounces, ball_track, homography_matrices, kps_court, persons_top, persons_bottom,
-                    draw_trace=True)
+    # frames are decoded again for rendering instead of being kept in memory
+    imgs_res = main(iter_video(args.path_input_video), scenes, bounces, ball_track, homography_matrices, kps_court,
+                    persons_top, persons_bottom, draw_trace=True)
 
     write(imgs_res, fps, args.path_output_video)
-
-
-
-
-
@@ -0,0 +1,66 @@
+import sys
+sys.path.append('.')
+
+from ai.ball_detector import BallDetector
+from utils2.video_utils import iter_video
+import argparse
+import itertools
+import json
+import resource
+import subprocess
+import time
+import torch
+
+
+def run(args):
+    """
+    Detect the ball with one configuration and print the track, time and peak memory as json
+    """
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    ball_detector = BallDetector(args.model, device, backend=args.backend, tile_rows=args.tile_rows)
+    frames = itertools.islice(iter_video(args.path_input_video), args.num_frames)
+    start = time.time()
+    track = list(ball_detector.infer_frames(frames, batch_size=args.batch_size))
+    elapsed = time.time() - start
+    result = {
+        'track': [[None if v is None else float(v) for v in point] for point in track],
+        'time': elapsed,
+        # ru_maxrss is reported in kilobytes on linux
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'max_cuda_mb': torch.cuda.max_memory_allocated() / 2 ** 20 if device == 'cuda' else None,
+    }
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    # Compare speed and peak memory of full and tiled evaluation of the last TrackNet block.
+    # Every configuration runs in its own process so peak memory is measured separately
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, help='path to pretrained model for ball detection')
+    parser.add_argument('--path_input_video', type=str, help='path to input video')
+    parser.add_argument('--num_frames', type=int, default=100, help='number of frames to process')
+    parser.add_argument('--batch_size', type=int, default=4, help='number of frames per forward pass')
+    parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'fused'])
+    parser.add_argument('--tile_rows', type=int, nargs='+', default=[0, 90, 45],
+                        help='tile heights to compare, 0 evaluates the last block at once')
+    args = parser.parse_args()
+
+    if len(args.tile_rows) == 1:
+        args.tile_rows = args.tile_rows[0] or None
+        run(args)
+        sys.exit(0)
+
+    reference = None
+    print('tile rows | time per frame, s | max rss, MB | max cuda, MB | same track')
+    for tile_rows in args.tile_rows:
+        cmd = [sys.executable, __file__, '--model', args.model, '--path_input_video', args.path_input_video,
+               '--num_frames', str(args.num_frames), '--batch_size', str(args.batch_size),
+               '--backend', args.backend, '--tile_rows', str(tile_rows)]
+        output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if reference is None:
+            reference = result['track']
+        max_cuda = '-' if result['max_cuda_mb'] is None else '%.0f' % result['max_cuda_mb']
+        print('%9s | %17.3f | %11.0f | %12s | %s' % (
+            tile_rows or 'full', result['time'] / len(result['track']), result['max_rss_mb'], max_cuda,
+            result['track'] == reference))
@@ -0,0 +1,153 @@
+import sys
+sys.path.append('.')
+
+from ai.bounce_detector import BounceDetector
+import argparse
+import numpy as np
+import pandas as pd
+import time
+
+
+def reference_prepare_features(x_ball, y_ball):
+    # previous BounceDetector.prepare_features
+    labels = pd.DataFrame({'frame': range(len(x_ball)), 'x-coordinate': x_ball, 'y-coordinate': y_ball})
+
+    num = 3
+    eps = 1e-15
+    for i in range(1, num):
+        labels['x_lag_{}'.format(i)] = labels['x-coordinate'].shift(i)
+        labels['x_lag_inv_{}'.format(i)] = labels['x-coordinate'].shift(-i)
+        labels['y_lag_{}'.format(i)] = labels['y-coordinate'].shift(i)
+        labels['y_lag_inv_{}'.format(i)] = labels['y-coordinate'].shift(-i)
+        labels['x_diff_{}'.format(i)] = abs(labels['x_lag_{}'.format(i)] - labels['x-coordinate'])
+        labels['y_diff_{}'.format(i)] = labels['y_lag_{}'.format(i)] - labels['y-coordinate']
+        labels['x_diff_inv_{}'.format(i)] = abs(labels['x_lag_inv_{}'.format(i)] - labels['x-coordinate'])
+        labels['y_diff_inv_{}'.format(i)] = labels['y_lag_inv_{}'.format(i)] - labels['y-coordinate']
+        labels['x_div_{}'.format(i)] = abs(labels['x_diff_{}'.format(i)]/(labels['x_diff_inv_{}'.format(i)] + eps))
+        labels['y_div_{}'.format(i)] = labels['y_diff_{}'.format(i)]/(labels['y_diff_inv_{}'.format(i)] + eps)
+
+    for i in range(1, num):
+        labels = labels[labels['x_lag_{}'.format(i)].notna()]
+        labels = labels[labels['x_lag_inv_{}'.format(i)].notna()]
+    labels = labels[labels['x-coordinate'].notna()]
+
+    colnames_x = ['x_diff_{}'.format(i) for i in range(1, num)] + \
+                 ['x_diff_inv_{}'.format(i) for i in range(1, num)] + \
+                 ['x_div_{}'.format(i) for i in range(1, num)]
+    colnames_y = ['y_diff_{}'.format(i) for i in range(1, num)] + \
+                 ['y_diff_inv_{}'.format(i) for i in range(1, num)] + \
+                 ['y_div_{}'.format(i) for i in range(1, num)]
+    colnames = colnames_x + colnames_y
+
+    features = labels[colnames]
+    return features, list(labels['frame'])
+
+
+def random_track(rng, length):
+    x_ball = list(rng.uniform(0, 1280, length))
+    y_ball = list(rng.uniform(0, 720, length))
+    # repeated coordinates give zero differences
+    for num in np.nonzero(rng.random(length) < 0.1)[0][1:]:
+        x_ball[num], y_ball[num] = x_ball[num - 1], y_ball[num - 1]
+    for num in np.nonzero(rng.random(length) < rng.random() * 0.5)[0]:
+        x_ball[num], y_ball[num] = None, None
+    return x_ball, y_ball
+
+
+class LowestPointModel:
+    # stands in for the CatBoost model, a bounce is the lowest point of the ball on the image
+    def predict(self, features):
+        y_diffs = features[:, 6:10]
+        return np.where((y_diffs < 0).all(axis=1), 0.6 + 0.3 * np.tanh(-y_diffs.max(axis=1) / 10), 0.1)
+
+
+def bouncing_track(rng, length):
+    x_ball, y_ball = [], []
+    x, vx = rng.uniform(100, 1180), rng.uniform(-8, 8)
+    while len(x_ball) < length:
+        # one flight of the ball between two bounces
+        duration = int(rng.integers(15, 45))
+        floor, height = rng.uniform(400, 700), rng.uniform(50, 300)
+        for t in range(duration):
+            x = np.clip(x + vx, 0, 1279)
+            x_ball.append(x + rng.normal(0, 1))
+            y_ball.append(floor - 4 * height * t * (duration - t) / duration ** 2 + rng.normal(0, 1))
+    x_ball, y_ball = x_ball[:length], y_ball[:length]
+    for num in np.nonzero(rng.random(length) < 0.05)[0]:
+        for gap in range(num, min(num + int(rng.integers(1, 6)), length)):
+            x_ball[gap], y_ball[gap] = None, None
+    return x_ball, y_ball
+
+
+def check_window_predictions(bounce_detector, rng, num_trials, length, window):
+    # bounces beyond the first half of the window are compared, smoothing and merging only differ before
+    same_predict = 0
+    same_update = 0
+    num_bounces = 0
+    num_different = 0
+    for trial in range(num_trials):
+        x_ball, y_ball = bouncing_track(rng, length)
+        expected = bounce_detector.predict(list(x_ball), list(y_ball))
+        predicted = bounce_detector.predict(list(x_ball), list(y_ball), window=window)
+        keep_until = length - window + window // 2
+        same_predict += {frame for frame in expected if frame >= keep_until} == \
+            {frame for frame in predicted if frame >= keep_until}
+
+        # the track grows frame by frame and is smoothed as a whole like in VideoProcessor
+        bounces = []
+        for num in range(1, length + 1):
+            x_track, y_track = bounce_detector.smooth_predictions(list(x_ball[:num]), list(y_ball[:num]))
+            bounces = bounce_detector.update_bounces(bounces, x_track, y_track, window, smooth=False)
+        same_update += set(bounces) == expected
+        num_bounces += len(expected)
+        num_different += len(set(bounces) ^ expected)
+    print('predict(window=%d) same as predict() after the window start: %d of %d tracks' %
+          (window, same_predict, num_trials))
+    print('update_bounces frame by frame same as predict(): %d of %d tracks, %d different of %d bounces' %
+          (same_update, num_trials, num_different, num_bounces))
+
+
+if __name__ == '__main__':
+    # Check that the array based bounce features are the same as the pandas features,
+    # and compare bounces predicted on the last frames of a track with the whole track
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_trials', type=int, default=200, help='number of random ball tracks to compare')
+    parser.add_argument('--length', type=int, default=3000, help='length of the track used for timing')
+    parser.add_argument('--num_tracks', type=int, default=20,
+                        help='number of bouncing ball tracks to compare windowed predictions on')
+    parser.add_argument('--window', type=int, default=100, help='number of last frames predicted')
+    args = parser.parse_args()
+    bounce_detector = BounceDetector()
+    rng = np.random.default_rng(0)
+    failures = 0
+
+    for trial in range(args.num_trials):
+        x_ball, y_ball = random_track(rng, int(rng.integers(0, 60)))
+        expected, expected_frames = reference_prepare_features(x_ball, y_ball)
+        features, frames = bounce_detector.prepare_features(x_ball, y_ball)
+        if frames != expected_frames or not np.array_equal(features, expected.to_numpy(), equal_nan=True):
+            failures += 1
+        # the rows of a trailing window are the last rows of the full features
+        window = int(rng.integers(0, 20))
+        features, frames = bounce_detector.prepare_features(x_ball, y_ball, window)
+        tail = [n for n, frame in enumerate(expected_frames) if frame >= len(x_ball) - window]
+        if frames != [expected_frames[n] for n in tail] or \
+                not np.array_equal(features, expected.to_numpy()[tail], equal_nan=True):
+            failures += 1
+
+    x_ball, y_ball = random_track(rng, args.length)
+    start = time.time()
+    reference_prepare_features(x_ball, y_ball)
+    pandas_time = time.time() - start
+    start = time.time()
+    bounce_detector.prepare_features(x_ball, y_ball)
+    array_time = time.time() - start
+    start = time.time()
+    bounce_detector.prepare_features(x_ball, y_ball, 50)
+    window_time = time.time() - start
+    print('%d frames: pandas %.4f s, arrays %.4f s, window of 50 frames %.4f s' %
+          (args.length, pandas_time, array_time, window_time))
+    print('OK' if not failures else '%d MISMATCHES' % failures)
+
+    bounce_detector.model = LowestPointModel()
+    check_window_predictions(bounce_detector, rng, args.num_tracks, 400, args.window)
@@ -0,0 +1,43 @@
+from court_detector import CourtDetector
+from utils2.video_utils import iter_video
+import argparse
+import itertools
+import numpy as np
+import time
+
+
+if __name__ == '__main__':
+    # Check how often the sparse ranking of candidate homographies finds the same court as the exhaustive search
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_input_video', type=str, help='path to input video')
+    parser.add_argument('--num_frames', type=int, default=20, help='number of video frames to compare')
+    parser.add_argument('--frame_step', type=int, default=30, help='compare every frame_step-th frame')
+    args = parser.parse_args()
+    court_detector = CourtDetector()
+    matches = 0
+    compared = 0
+
+    frames = itertools.islice(iter_video(args.path_input_video), 0, None, args.frame_step)
+    for num, frame in enumerate(itertools.islice(frames, args.num_frames)):
+        court_detector.frame = frame
+        court_detector.v_height, court_detector.v_width = frame.shape[:2]
+        court_detector.gray = court_detector._threshold(frame)
+        filtered = court_detector._filter_pixels(court_detector.gray)
+        horizontal_lines, vertical_lines = court_detector._detect_lines(filtered)
+
+        results = []
+        for num_rescored in (10, None):
+            court_detector.num_rescored = num_rescored
+            start = time.time()
+            matrix, _, score = court_detector._find_homography(horizontal_lines, vertical_lines)
+            results.append((matrix, score, time.time() - start))
+        (matrix, score, sparse_time), (best_matrix, best_score, exhaustive_time) = results
+        if best_matrix is None:
+            print('frame %d: no court' % (num * args.frame_step))
+            continue
+        same = matrix is not None and np.allclose(matrix, best_matrix, atol=1e-6 * np.abs(best_matrix).max())
+        matches += same
+        compared += 1
+        print('frame %d: score %.1f / %.1f same %s time %.3f s / %.3f s' %
+              (num * args.frame_step, score, best_score, same, sparse_time, exhaustive_time))
+    print('%d of %d frames match the exhaustive search' % (matches, compared))
@@ -0,0 +1,59 @@
+from court_detector import CourtDetector
+from utils2.video_utils import iter_video
+import argparse
+import itertools
+import numpy as np
+import time
+
+
+def reference_filter_pixels(gray, dist_tau=3, intensity_threshold=40):
+    # previous CourtDetector._filter_pixels
+    for i in range(dist_tau, len(gray) - dist_tau):
+        for j in range(dist_tau, len(gray[0]) - dist_tau):
+            if gray[i, j] == 0:
+                continue
+            if gray[i, j] - gray[i + dist_tau, j] > intensity_threshold and \
+                    gray[i, j] - gray[i - dist_tau, j] > intensity_threshold:
+                continue
+            if gray[i, j] - gray[i, j + dist_tau] > intensity_threshold and \
+                    gray[i, j] - gray[i, j - dist_tau] > intensity_threshold:
+                continue
+            gray[i, j] = 0
+    return gray
+
+
+if __name__ == '__main__':
+    # Check that the array based pixel filter gives the same result as the pixel loop
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_input_video', type=str, help='path to input video')
+    parser.add_argument('--num_frames', type=int, default=5, help='number of video frames to compare')
+    parser.add_argument('--num_trials', type=int, default=50, help='number of random images to compare')
+    args = parser.parse_args()
+    court_detector = CourtDetector()
+    rng = np.random.default_rng(0)
+    failures = 0
+
+    images = []
+    if args.path_input_video:
+        images = [court_detector._threshold(frame)
+                  for frame in itertools.islice(iter_video(args.path_input_video), args.num_frames)]
+    for trial in range(args.num_trials):
+        shape = rng.integers(1, 100, 2)
+        if trial % 2:
+            images.append(rng.integers(0, 256, shape).astype(np.uint8))
+        else:
+            images.append((rng.random(shape) < rng.random()).astype(np.uint8) * 255)
+
+    with np.errstate(over='ignore'):
+        for image in images:
+            start = time.time()
+            expected = reference_filter_pixels(image.copy())
+            loop_time = time.time() - start
+            start = time.time()
+            filtered = court_detector._filter_pixels(image.copy())
+            array_time = time.time() - start
+            if not np.array_equal(filtered, expected):
+                failures += 1
+            if image.shape[0] >= 360:
+                print('%dx%d: loop %.3f s, arrays %.3f s' % (image.shape[1], image.shape[0], loop_time, array_time))
+    print('OK' if not failures else '%d MISMATCHES' % failures)
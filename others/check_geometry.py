@@ -0,0 +1,143 @@
+import sys
+sys.path.append('.')
+
+from ai.geometry import (intersect_lines, sort_intersection_points, merge_lines,
+                         merge_horizontal_lines, merge_vertical_lines)
+from scipy.spatial import distance
+from sympy import Line
+from sympy.geometry.point import Point2D
+import argparse
+import numpy as np
+
+
+def sympy_intersection(line1, line2):
+    l1 = Line((line1[0], line1[1]), (line1[2], line1[3]))
+    l2 = Line((line2[0], line2[1]), (line2[2], line2[3]))
+    intersection = l1.intersection(l2)
+    if len(intersection) > 0 and isinstance(intersection[0], Point2D):
+        return intersection[0].coordinates
+    return None
+
+
+def reference_merge_lines(lines):
+    # previous ai.postprocess.merge_lines
+    lines = sorted(lines, key=lambda item: item[0])
+    mask = [True] * len(lines)
+    new_lines = []
+    for i, line in enumerate(lines):
+        if mask[i]:
+            for j, s_line in enumerate(lines[i + 1:]):
+                if mask[i + j + 1]:
+                    x1, y1, x2, y2 = line
+                    x3, y3, x4, y4 = s_line
+                    dist1 = distance.euclidean((x1, y1), (x3, y3))
+                    dist2 = distance.euclidean((x2, y2), (x4, y4))
+                    if dist1 < 20 and dist2 < 20:
+                        line = np.array([int((x1+x3)/2), int((y1+y3)/2), int((x2+x4)/2), int((y2+y4)/2)])
+                        mask[i + j + 1] = False
+            new_lines.append(line)
+    return new_lines
+
+
+def reference_merge_horizontal(lines):
+    # previous ai.court_detector.CourtDetector._merge_lines for horizontal lines
+    lines = sorted(lines, key=lambda item: item[0])
+    mask = [True] * len(lines)
+    new_lines = []
+    for i, line in enumerate(lines):
+        if mask[i]:
+            for j, s_line in enumerate(lines[i + 1:]):
+                if mask[i + j + 1]:
+                    x1, y1, x2, y2 = line
+                    x3, y3, x4, y4 = s_line
+                    if abs(y3 - y2) < 10:
+                        points = sorted([(x1, y1), (x2, y2), (x3, y3), (x4, y4)], key=lambda x: x[0])
+                        line = np.array([*points[0], *points[-1]])
+                        mask[i + j + 1] = False
+            new_lines.append(line)
+    return new_lines
+
+
+def reference_merge_vertical(lines, height, width):
+    # previous ai.court_detector.CourtDetector._merge_lines for vertical lines
+    lines = sorted(lines, key=lambda item: item[1])
+    xl, yl, xr, yr = (0, height * 6 / 7, width, height * 6 / 7)
+    mask = [True] * len(lines)
+    new_lines = []
+    for i, line in enumerate(lines):
+        if mask[i]:
+            for j, s_line in enumerate(lines[i + 1:]):
+                if mask[i + j + 1]:
+                    x1, y1, x2, y2 = line
+                    x3, y3, x4, y4 = s_line
+                    xi, yi = sympy_intersection((x1, y1, x2, y2), (xl, yl, xr, yr))
+                    xj, yj = sympy_intersection((x3, y3, x4, y4), (xl, yl, xr, yr))
+                    if abs(xi - xj) < 10:
+                        points = sorted([(x1, y1), (x2, y2), (x3, y3), (x4, y4)], key=lambda x: x[1])
+                        line = np.array([*points[0], *points[-1]])
+                        mask[i + j + 1] = False
+            new_lines.append(line)
+    return new_lines
+
+
+def reference_sort(intersections):
+    y_sorted = sorted(intersections, key=lambda x: x[1])
+    return sorted(y_sorted[:2], key=lambda x: x[0]) + sorted(y_sorted[2:], key=lambda x: x[0])
+
+
+def random_lines(rng, num, horizontal):
+    # short lines close to each other, so that many of them get merged
+    x1 = rng.integers(0, 1280, num)
+    y1 = rng.integers(0, 720, num)
+    length = rng.integers(10, 200, num)
+    slope = rng.integers(-15, 15, num)
+    if horizontal:
+        return np.stack([x1, y1, x1 + length, y1 + slope], axis=1)
+    return np.stack([x1, y1, x1 + slope, y1 + length], axis=1)
+
+
+if __name__ == "__main__":
+    # Check that the NumPy geometry kernels give the same results as the sympy based code they replaced
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_trials", type=int, default=200, help="number of random line sets")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    failures = []
+
+    lines1 = rng.integers(-50, 1330, (args.num_trials, 4))
+    lines2 = rng.integers(-50, 1330, (args.num_trials, 4))
+    # parallel and integer-valued intersections are corner cases of the closed form
+    lines2[:10] = lines1[:10] + rng.integers(-20, 20, (10, 1)) * np.array([0, 1, 0, 1])
+    lines2[10:20] = np.stack([lines1[10:20, 0], lines1[10:20, 1] + 7, lines1[10:20, 0] + 3, lines1[10:20, 1]], axis=1)
+    points = intersect_lines(lines1, lines2)
+    for line1, line2, point in zip(lines1, lines2, points):
+        expected = sympy_intersection(line1, line2)
+        if expected is None:
+            if not np.isnan(point).all():
+                failures.append(('intersection', line1, line2, point, expected))
+        elif (int(point[0]), int(point[1])) != (int(expected[0]), int(expected[1])) or \
+                not np.allclose(point, [float(v) for v in expected]):
+            failures.append(('intersection', line1, line2, point, expected))
+
+    for trial in range(args.num_trials):
+        quads = rng.integers(0, 1280, (4, 2))
+        if not np.array_equal(sort_intersection_points(quads), np.array(reference_sort(list(quads)))):
+            failures.append(('sort', quads))
+
+        lines = random_lines(rng, rng.integers(2, 20), horizontal=trial % 2 == 0)
+        merged = merge_lines(lines)
+        if not np.array_equal(merged, np.array(reference_merge_lines(list(lines))).reshape(-1, 4)):
+            failures.append(('merge_lines', lines))
+        merged = merge_horizontal_lines(lines)
+        if not np.array_equal(merged, np.array(reference_merge_horizontal(list(lines))).reshape(-1, 4)):
+            failures.append(('merge_horizontal_lines', lines))
+        lines = random_lines(rng, rng.integers(2, 20), horizontal=False)
+        merged = merge_vertical_lines(lines, 720, 1280)
+        if not np.array_equal(merged, np.array(reference_merge_vertical(list(lines), 720, 1280)).reshape(-1, 4)):
+            failures.append(('merge_vertical_lines', lines))
+
+    for failure in failures[:10]:
+        print(*failure)
+    print("OK" if not failures else "%d MISMATCHES" % len(failures))
+    sys.exit(0 if not failures else 1)
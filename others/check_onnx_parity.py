@@ -0,0 +1,58 @@
+import sys
+sys.path.append('.')
+
+from ai.ball_detector import BallDetector
+from ai.court_detection_net import CourtDetectorNet
+from utils2.video_utils import iter_video
+import argparse
+import itertools
+import numpy as np
+import torch
+
+if __name__ == "__main__":
+    # Compare outputs of the torch backend and another backend on the first frames of a video
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path_ball_track_model", type=str, help="path to pretrained model for ball detection")
+    parser.add_argument("--path_court_model", type=str, help="path to pretrained model for court detection")
+    parser.add_argument("--path_input_video", type=str, help="path to input video")
+    parser.add_argument("--num_frames", type=int, default=100, help="number of frames to compare")
+    parser.add_argument("--backend", type=str, default="onnx", choices=["fused", "onnx"], help="backend to compare with torch")
+    args = parser.parse_args()
+
+    frames = list(itertools.islice(iter_video(args.path_input_video), args.num_frames))
+    ok = True
+
+    if args.path_ball_track_model:
+        ball_torch = BallDetector(args.path_ball_track_model, "cpu")
+        ball_onnx = BallDetector(args.path_ball_track_model, "cpu", backend=args.backend)
+        inp = np.concatenate([ball_torch.prepare(frame) for frame in frames[:3]][::-1], axis=0)[None]
+        with torch.inference_mode():
+            out_torch = ball_torch.model(torch.from_numpy(inp)).numpy()
+            out_onnx = ball_onnx.model(torch.from_numpy(inp)).numpy()
+        print("ball: max abs output difference %.2e" % np.abs(out_torch - out_onnx).max())
+        print("ball: argmax agreement %.6f" % (out_torch.argmax(1) == out_onnx.argmax(1)).mean())
+        track_torch = ball_torch.infer_model(frames)
+        track_onnx = ball_onnx.infer_model(frames)
+        same = sum(a == b for a, b in zip(track_torch, track_onnx))
+        print("ball: %d of %d ball positions are identical" % (same, len(frames)))
+        ok = ok and same == len(frames)
+
+    if args.path_court_model:
+        court_torch = CourtDetectorNet(args.path_court_model, "cpu")
+        court_onnx = CourtDetectorNet(args.path_court_model, "cpu", backend=args.backend)
+        matrixes_torch, kps_torch = court_torch.infer_model(frames)
+        matrixes_onnx, kps_onnx = court_onnx.infer_model(frames)
+        dists = []
+        missing = 0
+        for kps1, kps2 in zip(kps_torch, kps_onnx):
+            if (kps1 is None) != (kps2 is None):
+                missing += 1
+            elif kps1 is not None:
+                dists.append(np.abs(kps1 - kps2).max())
+        print("court: frames detected by one backend only: %d" % missing)
+        if len(dists) > 0:
+            print("court: max keypoint difference %.3f px" % max(dists))
+        ok = ok and missing == 0 and (len(dists) == 0 or max(dists) < 1)
+
+    print("OK" if ok else "MISMATCH")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,68 @@
+import sys
+sys.path.append('.')
+
+from ai.ball_detector import BallDetector
+from utils2.video_utils import iter_video, get_video_size
+import argparse
+import numpy as np
+import torch
+
+if __name__ == "__main__":
+    # Compare ball positions decoded with HoughCircles on whole masks and on crops of a batch
+    # from the same network outputs, the decoders should agree on every frame
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, help="path to pretrained model for ball detection")
+    parser.add_argument("--path_input_video", type=str, help="path to input video")
+    parser.add_argument("--batch_size", type=int, default=8, help="number of frames per forward pass")
+    parser.add_argument("--path_masks", "--masks", type=str,
+                        help="path to .npy ball masks recorded with --save_masks, used instead of the model")
+    parser.add_argument("--save_masks", type=str, help="path to save the ball masks of the video as .npy")
+    parser.add_argument("--max_dist", type=float, default=2.0,
+                        help="maximum distance in original pixels of positions counted as a match")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    ball_detector = BallDetector(args.model, device)
+
+    if args.path_masks:
+        masks = np.load(args.path_masks)
+        scale = [2, 2]
+    else:
+        outputs = []
+        original = ball_detector.infer_batch
+        def infer_batch(inp):
+            output = original(inp)
+            outputs.append(output.copy())
+            return output
+        ball_detector.infer_batch = infer_batch
+        ball_detector.infer_model(iter_video(args.path_input_video), batch_size=args.batch_size)
+        masks = np.concatenate(outputs)
+        width, height = get_video_size(args.path_input_video)
+        scale = [width / ball_detector.width, height / ball_detector.height]
+        if args.save_masks:
+            np.save(args.save_masks, masks)
+
+    tracks = {}
+    for decoder in ("hough", "blob"):
+        ball_detector.decoder = decoder
+        prev_pred = [None, None]
+        tracks[decoder] = []
+        for start in range(0, len(masks), args.batch_size):
+            tracks[decoder] += list(ball_detector.postprocess_batch(masks[start:start + args.batch_size],
+                                                                    prev_pred, scale))
+
+    dists = []
+    mismatch = 0
+    for (x1, y1), (x2, y2) in zip(tracks["hough"], tracks["blob"]):
+        if (x1 is None) != (x2 is None):
+            mismatch += 1
+        elif x1 is not None:
+            dists.append(np.hypot(x1 - x2, y1 - y2))
+    dists = np.array(dists)
+    matches = len(masks) - mismatch - np.sum(dists > args.max_dist)
+    print("frames:", len(masks))
+    print("detected by one decoder only:", mismatch)
+    if len(dists) > 0:
+        print("distance between decoders, median / 95%% / max: %.2f / %.2f / %.2f" % (
+            np.median(dists), np.percentile(dists, 95), dists.max()))
+    print("same result within %.1f pixels: %.1f%%" % (args.max_dist, 100 * matches / max(len(masks), 1)))
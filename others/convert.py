@@ -1,4 +1,5 @@
 from ball_detector import BallDetector
+from onnx_backend import get_onnx_path
 import argparse
 import torch
 
@@ -15,4 +16,4 @@ if __name__ == "__main__":
     print(torch.__version__)
     print(torch.onnx.__name__)
     ball_detector = BallDetector(args.model, device)
-    ball_detector.convert_to_onnx() 
+    ball_detector.convert_to_onnx(get_onnx_path(args.model))
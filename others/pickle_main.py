@@ -6,23 +6,50 @@ from court_reference import CourtReference
 from bounce_detector import BounceDetector
 from person_detector import PersonDetector
 from ball_detector import BallDetector
-from utils import scene_detect
+from utils import SceneDetector
+from utils2.video_utils import iter_video, get_video_fps, get_video_size
+import itertools
 import argparse
 import torch
 from tqdm import tqdm
 
-def read_video(path_video):
-    cap = cv2.VideoCapture(path_video)
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
-    frames = []
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if ret:
-            frames.append(frame)
+def analyze_video(path_video, ball_detector, court_detector, person_detector, batch_size=1):
+    """
+    Run scene, court, ball and person detection in a single streaming pass over the video
+    """
+    ball_track = []
+    homography_matrices = []
+    kps_court = []
+    persons_top = []
+    persons_bottom = []
+    # frames are downscaled once for the ball network and the scene detector;
+    # both copies are consumed in lockstep, so tee keeps at most one batch of frames
+    width, height = get_video_size(path_video)
+    frames = ((frame, cv2.resize(frame, (ball_detector.width, ball_detector.height)))
+              for frame in iter_video(path_video))
+    frames, frames_ball = itertools.tee(frames)
+    frames_ball = (img for frame, img in frames_ball)
+    scale = (width / ball_detector.width, height / ball_detector.height)
+    scene_detector = SceneDetector()
+    print("Detecting the court, the ball and the players...")
+    for frame_i, ((frame, img), ball_point) in enumerate(zip(frames, tqdm(ball_detector.infer_frames(frames_ball, scale, batch_size)))):
+        scene_detector.process_frame(img)
+        if frame_i == 0:
+            lines = court_detector.detect(frame)
+        else:  # then track it
+            lines = court_detector.track_court(frame)
+        matrix = court_detector.game_warp_matrix[-1]
+        if matrix is not None:
+            person_top, person_bottom = person_detector.detect_top_and_bottom_players(frame, matrix)
         else:
-            break    
-    cap.release()
-    return frames, fps
+            person_top, person_bottom = [], []
+        ball_track.append(ball_point)
+        homography_matrices.append(matrix)
+        kps_court.append(None)
+        persons_top.append(person_top)
+        persons_bottom.append(person_bottom)
+    scenes = scene_detector.get_scenes()
+    return scenes, ball_track, homography_matrices, kps_court, persons_top, persons_bottom
 
 def get_court_img():
     court_reference = CourtReference()
@@ -35,7 +62,7 @@ def main(frames, scenes, bounces, ball_track, homography_matrices, kps_court, pe
          draw_trace=False, trace=7):
     """
     :params
-        frames: list of original images
+        frames: iterable of original images
         scenes: list of beginning and ending of video fragment
         bounces: list of image numbers where ball touches the ground
         ball_track: list of (x,y) ball coordinates
@@ -46,93 +73,99 @@ def main(frames, scenes, bounces, ball_track, homography_matrices, kps_court, pe
         draw_trace: whether to draw ball trace
         trace: the length of ball trace
     :return
-        imgs_res: list of resulting images
+        generator of resulting images
     """
-    imgs_res = []
     width_minimap = 166
     height_minimap = 350
     is_track = [x is not None for x in homography_matrices] 
-    for num_scene in range(len(scenes)):
-        sum_track = sum(is_track[scenes[num_scene][0]:scenes[num_scene][1]])
-        len_track = scenes[num_scene][1] - scenes[num_scene][0]
-
-        eps = 1e-15
-        scene_rate = sum_track/(len_track+eps)
-        if (scene_rate > 0.5):
+    num_scene = -1
+    for i, img_res in enumerate(frames):
+        if num_scene == -1 or i >= scenes[num_scene][1]:
+            num_scene += 1
+            while num_scene < len(scenes) and i >= scenes[num_scene][1]:
+                num_scene += 1
+            if num_scene == len(scenes):
+                break
+            sum_track = sum(is_track[scenes[num_scene][0]:scenes[num_scene][1]])
+            len_track = scenes[num_scene][1] - scenes[num_scene][0]
+
+            eps = 1e-15
+            scene_rate = sum_track/(len_track+eps)
             court_img = get_court_img()
+        if i < scenes[num_scene][0]:
+            continue
+        if (scene_rate <= 0.5):
+            yield img_res
+            continue
+
+        inv_mat = homography_matrices[i]
+
+        # draw ball trajectory
+        if ball_track[i][0]:
+            if draw_trace:
+                for j in range(0, trace):
+                    if i-j >= 0:
+                        if ball_track[i-j][0]:
+                            draw_x = int(ball_track[i-j][0])
+                            draw_y = int(ball_track[i-j][1])
+                            img_res = cv2.circle(img_res, (draw_x, draw_y),
+                            radius=3, color=(0, 255, 0), thickness=2)
+            else:    
+                img_res = cv2.circle(img_res , (int(ball_track[i][0]), int(ball_track[i][1])), radius=5,
+                                     color=(0, 255, 0), thickness=2)
+                img_res = cv2.putText(img_res, 'ball', 
+                      org=(int(ball_track[i][0]) + 8, int(ball_track[i][1]) + 8),
+                      fontFace=cv2.FONT_HERSHEY_SIMPLEX,
+                      fontScale=0.8,
+                      thickness=2,
+                      color=(0, 255, 0))
+
+        # draw court keypoints
+        if kps_court[i] is not None:
+            for j in range(len(kps_court[i])):
+                img_res = cv2.circle(img_res, (int(kps_court[i][j][0, 0]), int(kps_court[i][j][0, 1])),
+                                  radius=0, color=(0, 0, 255), thickness=10)
+
+        height, width, _ = img_res.shape
+
+        # draw bounce in minimap
+        if i in bounces and inv_mat is not None:
+            ball_point = ball_track[i]
+            ball_point = np.array(ball_point, dtype=np.float32).reshape(1, 1, 2)
+            ball_point = cv2.perspectiveTransform(ball_point, inv_mat)
+            court_img = cv2.circle(court_img, (int(ball_point[0, 0, 0]), int(ball_point[0, 0, 1])),
+                                               radius=0, color=(0, 255, 255), thickness=50)
+
+        minimap = court_img.copy()
+
+        # draw persons
+        persons = persons_top[i] + persons_bottom[i]                    
+        for j, person in enumerate(persons):
+            if len(person[0]) > 0:
+                person_bbox = list(person[0])
+                img_res = cv2.rectangle(img_res, (int(person_bbox[0]), int(person_bbox[1])),
+                                        (int(person_bbox[2]), int(person_bbox[3])), [255, 0, 0], 2)
+
+                # transmit person point to minimap
+                person_point = list(person[1])
+                person_point = np.array(person_point, dtype=np.float32).reshape(1, 1, 2)
+                person_point = cv2.perspectiveTransform(person_point, inv_mat)
+                minimap = cv2.circle(minimap, (int(person_point[0, 0, 0]), int(person_point[0, 0, 1])),
+                                                   radius=0, color=(255, 0, 0), thickness=80)
+
+        minimap = cv2.resize(minimap, (width_minimap, height_minimap))
+        img_res[30:(30 + height_minimap), (width - 30 - width_minimap):(width - 30), :] = minimap
+        yield img_res
 
-            for i in range(scenes[num_scene][0], scenes[num_scene][1]):
-                img_res = frames[i]
-                inv_mat = homography_matrices[i]
-
-                # draw ball trajectory
-                if ball_track[i][0]:
-                    if draw_trace:
-                        for j in range(0, trace):
-                            if i-j >= 0:
-                                if ball_track[i-j][0]:
-                                    draw_x = int(ball_track[i-j][0])
-                                    draw_y = int(ball_track[i-j][1])
-                                    img_res = cv2.circle(frames[i], (draw_x, draw_y),
-                                    radius=3, color=(0, 255, 0), thickness=2)
-                    else:    
-                        img_res = cv2.circle(img_res , (int(ball_track[i][0]), int(ball_track[i][1])), radius=5,
-                                             color=(0, 255, 0), thickness=2)
-                        img_res = cv2.putText(img_res, 'ball', 
-                              org=(int(ball_track[i][0]) + 8, int(ball_track[i][1]) + 8),
-                              fontFace=cv2.FONT_HERSHEY_SIMPLEX,
-                              fontScale=0.8,
-                              thickness=2,
-                              color=(0, 255, 0))
-
-                # draw court keypoints
-                if kps_court[i] is not None:
-                    for j in range(len(kps_court[i])):
-                        img_res = cv2.circle(img_res, (int(kps_court[i][j][0, 0]), int(kps_court[i][j][0, 1])),
-                                          radius=0, color=(0, 0, 255), thickness=10)
-
-                height, width, _ = img_res.shape
-
-                # draw bounce in minimap
-                if i in bounces and inv_mat is not None:
-                    ball_point = ball_track[i]
-                    ball_point = np.array(ball_point, dtype=np.float32).reshape(1, 1, 2)
-                    ball_point = cv2.perspectiveTransform(ball_point, inv_mat)
-                    court_img = cv2.circle(court_img, (int(ball_point[0, 0, 0]), int(ball_point[0, 0, 1])),
-                                                       radius=0, color=(0, 255, 255), thickness=50)
-
-                minimap = court_img.copy()
-
-                # draw persons
-                persons = persons_top[i] + persons_bottom[i]                    
-                for j, person in enumerate(persons):
-                    if len(person[0]) > 0:
-                        person_bbox = list(person[0])
-                        img_res = cv2.rectangle(img_res, (int(person_bbox[0]), int(person_bbox[1])),
-                                                (int(person_bbox[2]), int(person_bbox[3])), [255, 0, 0], 2)
-
-                        # transmit person point to minimap
-                        person_point = list(person[1])
-                        person_point = np.array(person_point, dtype=np.float32).reshape(1, 1, 2)
-                        person_point = cv2.perspectiveTransform(person_point, inv_mat)
-                        minimap = cv2.circle(minimap, (int(person_point[0, 0, 0]), int(person_point[0, 0, 1])),
-                                                           radius=0, color=(255, 0, 0), thickness=80)
-
-                minimap = cv2.resize(minimap, (width_minimap, height_minimap))
-                img_res[30:(30 + height_minimap), (width - 30 - width_minimap):(width - 30), :] = minimap
-                imgs_res.append(img_res)
-
-        else:    
-            imgs_res = imgs_res + frames[scenes[num_scene][0]:scenes[num_scene][1]] 
-    return imgs_res        
- 
 def write(imgs_res, fps, path_output_video):
-    height, width = imgs_res[0].shape[:2]
-    out = cv2.VideoWriter(path_output_video, cv2.VideoWriter_fourcc(*'DIVX'), fps, (width, height))
-    for num in range(len(imgs_res)):
-        frame = imgs_res[num]
+    out = None
+    for frame in imgs_res:
+        if out is None:
+            height, width = frame.shape[:2]
+            out = cv2.VideoWriter(path_output_video, cv2.VideoWriter_fourcc(*'DIVX'), fps, (width, height))
         out.write(frame)
-    out.release()    
+    if out is not None:
+        out.release()    
 
 
 if __name__ == '__main__':
@@ -143,40 +176,18 @@ if __name__ == '__main__':
     parser.add_argument('--path_bounce_model', type=str, help='path to pretrained model for bounce detection')
     parser.add_argument('--path_input_video', type=str, help='path to input video')
     parser.add_argument('--path_output_video', type=str, help='path to output video')
+    parser.add_argument('--batch_size', type=int, default=1, help='number of frames per forward pass')
     args = parser.parse_args()
     
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    frames, fps = read_video(args.path_input_video) 
-    scenes = scene_detect(args.path_input_video)    
-
+    fps = get_video_fps(args.path_input_video)
 
-    print('court detection')
     #court_detector = CourtDetectorNet(args.path_court_model, device)
-    #homography_matrices, kps_court = court_detector.infer_model(frames)
-    kps_court = []
-    homography_matrices = []
-
     court_detector = CourtDetector()
-
-    print("Detecting the court and the players...")
-    for frame_i in tqdm(range(len(frames))):
-        frame = frames[frame_i]
-
-        if frame_i == 0:
-            lines = court_detector.detect(frame)
-        else:  # then track it
-            lines = court_detector.track_court(frame)
-        homography_matrices.append(court_detector.game_warp_matrix[frame_i])
-        kps_court.append(None)
-
-    print('ball detection')
     ball_detector = BallDetector(args.path_ball_track_model, device)
-    ball_track = ball_detector.infer_model(frames)
-        
-
-    print('person detection')
     person_detector = PersonDetector(device)
-    persons_top, persons_bottom = person_detector.track_players(frames, homography_matrices, filter_players=False)
+    scenes, ball_track, homography_matrices, kps_court, persons_top, persons_bottom = analyze_video(
+        args.path_input_video, ball_detector, court_detector, person_detector, args.batch_size)
 
     # bounce detection
     bounce_detector = BounceDetector(args.path_bounce_model)
@@ -184,12 +195,8 @@ if __name__ == '__main__':
     y_ball = [x[1] for x in ball_track]
     bounces = bounce_detector.predict(x_ball, y_ball)
 
-    imgs_res = main(frames, scenes, bounces, ball_track, homography_matrices, kps_court, persons_top, persons_bottom,
-                    draw_trace=True)
+    # frames are decoded again for rendering instead of being kept in memory
+    imgs_res = main(iter_video(args.path_input_video), scenes, bounces, ball_track, homography_matrices, kps_court,
+                    persons_top, persons_bottom, draw_trace=True)
 
     write(imgs_res, fps, args.path_output_video)
-
-
-
-
-
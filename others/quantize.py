@@ -0,0 +1,126 @@
+import sys
+sys.path.append('.')
+
+from ai.ball_detector import BallDetector
+from ai.court_detection_net import CourtDetectorNet
+from ai.onnx_backend import quantize_onnx_model
+from utils2.video_utils import iter_video
+from collections import deque
+import argparse
+import itertools
+import time
+import numpy as np
+
+
+def sample_frames(paths_video, step):
+    """
+    Yield every step-th frame of the videos together with the two frames before it
+    """
+    for path_video in paths_video:
+        window = deque(maxlen=3)
+        for num, frame in enumerate(iter_video(path_video)):
+            window.append(frame)
+            if len(window) == 3 and num % step == 0:
+                yield list(window)
+
+
+def ball_calibration_inputs(ball_detector, paths_video, step, num_inputs):
+    for window in itertools.islice(sample_frames(paths_video, step), num_inputs):
+        imgs = [ball_detector.prepare(frame) for frame in window[::-1]]
+        yield np.concatenate(imgs, axis=0)[None]
+
+
+def court_calibration_inputs(court_detector, paths_video, step, num_inputs):
+    for window in itertools.islice(sample_frames(paths_video, step), num_inputs):
+        yield np.ascontiguousarray(court_detector.prepare(window[-1]))
+
+
+def describe(dists):
+    if len(dists) == 0:
+        return 'no common detections'
+    return 'median %.2f px, 95%% %.2f px, max %.2f px' % (np.median(dists), np.percentile(dists, 95), np.max(dists))
+
+
+def ball_report(path_model, frames):
+    ball_float = BallDetector(path_model, 'cpu')
+    ball_int8 = BallDetector(path_model, 'cpu', backend='onnx-int8')
+    start = time.time()
+    track_float = ball_float.infer_model(frames)
+    time_float = time.time() - start
+    start = time.time()
+    track_int8 = ball_int8.infer_model(frames)
+    time_int8 = time.time() - start
+
+    dists = []
+    only_float, only_int8 = 0, 0
+    for (x1, y1), (x2, y2) in zip(track_float, track_int8):
+        if x1 is not None and x2 is not None:
+            dists.append(np.hypot(x1 - x2, y1 - y2))
+        elif x1 is not None:
+            only_float += 1
+        elif x2 is not None:
+            only_int8 += 1
+    print('ball detection on %d frames' % len(frames))
+    print('  detected by float model only: %d, by int8 model only: %d' % (only_float, only_int8))
+    print('  distance between positions: ' + describe(dists))
+    print('  time per frame: float %.3f s, int8 %.3f s' % (time_float / len(frames), time_int8 / len(frames)))
+
+
+def court_report(path_model, frames):
+    court_float = CourtDetectorNet(path_model, 'cpu')
+    court_int8 = CourtDetectorNet(path_model, 'cpu', backend='onnx-int8')
+    start = time.time()
+    _, kps_float = court_float.infer_model(frames)
+    time_float = time.time() - start
+    start = time.time()
+    _, kps_int8 = court_int8.infer_model(frames)
+    time_int8 = time.time() - start
+
+    dists = []
+    only_float, only_int8 = 0, 0
+    for kps1, kps2 in zip(kps_float, kps_int8):
+        if kps1 is not None and kps2 is not None:
+            dists.append(np.linalg.norm(kps1 - kps2, axis=2).max())
+        elif kps1 is not None:
+            only_float += 1
+        elif kps2 is not None:
+            only_int8 += 1
+    print('court detection on %d frames' % len(frames))
+    print('  court found by float model only: %d, by int8 model only: %d' % (only_float, only_int8))
+    print('  largest keypoint distance per frame: ' + describe(dists))
+    print('  time per frame: float %.3f s, int8 %.3f s' % (time_float / len(frames), time_int8 / len(frames)))
+
+
+if __name__ == '__main__':
+    # Calibrate INT8 models on our own footage, save them next to the weights
+    # and report how far their detections are from the float models
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_ball_track_model', type=str, help='path to pretrained model for ball detection')
+    parser.add_argument('--path_court_model', type=str, help='path to pretrained model for court detection')
+    parser.add_argument('--path_calibration_videos', type=str, nargs='+', help='videos to take calibration frames from')
+    parser.add_argument('--path_eval_video', type=str, help='video to compare float and int8 models on')
+    parser.add_argument('--num_calibration', type=int, default=300, help='number of calibration frames')
+    parser.add_argument('--step', type=int, default=25, help='take every step-th frame for calibration')
+    parser.add_argument('--num_eval', type=int, default=500, help='number of frames to compare models on')
+    args = parser.parse_args()
+
+    eval_frames = None
+    if args.path_eval_video:
+        eval_frames = list(itertools.islice(iter_video(args.path_eval_video), args.num_eval))
+
+    if args.path_ball_track_model:
+        ball_detector = BallDetector(args.path_ball_track_model, 'cpu')
+        inputs = ball_calibration_inputs(ball_detector, args.path_calibration_videos, args.step, args.num_calibration)
+        path_int8 = quantize_onnx_model(ball_detector.model, args.path_ball_track_model,
+                                        (9, ball_detector.height, ball_detector.width), inputs)
+        print('saved', path_int8)
+        if eval_frames:
+            ball_report(args.path_ball_track_model, eval_frames)
+
+    if args.path_court_model:
+        court_detector = CourtDetectorNet(args.path_court_model, 'cpu')
+        inputs = court_calibration_inputs(court_detector, args.path_calibration_videos, args.step, args.num_calibration)
+        path_int8 = quantize_onnx_model(court_detector.model, args.path_court_model, (3, 360, 640), inputs)
+        print('saved', path_int8)
+        if eval_frames:
+            court_report(args.path_court_model, eval_frames)
@@ -1,20 +1,8 @@
 from court_detector import CourtDetector
+from utils2.video_utils import iter_video
 import argparse
 import cv2
 
-def read_video(path_video):
-    cap = cv2.VideoCapture(path_video)
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
-    frames = []
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if ret:
-            frames.append(frame)
-        else:
-            break    
-    cap.release()
-    return frames, fps
-
 if __name__ == '__main__':
     # Create a CourtDetector object
     court_detector = CourtDetector()
@@ -22,18 +10,13 @@ if __name__ == '__main__':
     parser.add_argument('--path_input_video', type=str, help='path to input video')
     args = parser.parse_args()
     
-    frames, fps = read_video(args.path_input_video) 
-
-
     print('court detection')
     homography_marices = []
 
     court_detector = CourtDetector()
 
     print("Detecting the court and the players...")
-    for frame_i in range(len(frames)):
-        frame = frames[frame_i]
-
+    for frame_i, frame in enumerate(iter_video(args.path_input_video)):
         if frame_i == 0:
             lines = court_detector.detect(frame, verbose=1)
             break
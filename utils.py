@@ -24,3 +24,38 @@ def scene_detect(path_video):
     return scenes
 
 
+class SceneDetector:
+    """
+    Split video to disjoint fragments based on color histograms, frame by frame.
+    Works on frames that are already decoded (and downscaled) by the caller, so
+    the video does not have to be read a second time
+    """
+    def __init__(self):
+        self.detector = ContentDetector()
+        self.cuts = []
+        self.num_frames = 0
+        # the flash filter of the detector can report a cut up to this many frames after it happened
+        self.max_delay = self.detector.event_buffer_length
+
+    def process_frame(self, frame):
+        """
+        :params
+            frame: next consecutive video frame, any resolution
+        :return
+            list of frame numbers where a new scene starts, usually empty. A cut can be reported
+            up to max_delay frames after the frame it starts at
+        """
+        cuts = self.detector.process_frame(self.num_frames, frame)
+        self.cuts += cuts
+        self.num_frames += 1
+        return cuts
+
+    def get_scenes(self):
+        """
+        :return
+            scenes: list of beginning and ending of video fragments
+        """
+        cuts = self.cuts + self.detector.post_process(self.num_frames)
+        bounds = [0] + cuts + [self.num_frames]
+        scenes = [[bounds[i], bounds[i + 1]] for i in range(len(bounds) - 1)]
+        return scenes